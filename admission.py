@@ -0,0 +1,170 @@
+import os
+import threading
+
+# Decides how many reports this process makes at once. Every report holds pages of tracks, cover art and a share of
+# the render engine's time, so a burst of logins that all started at once could run the machine out of memory or
+# leave every report crawling along together. Instead each job worker asks here before it takes a job off the queue,
+# and a job that isn't let in just waits its turn in the queue (where the report page shows its position)
+#
+# The cap moves with what the machine is doing: a new job is only started if the memory available, less
+# MEMORY_RESERVE, still leaves room for one more job's worth of memory, and the machine's load isn't already over
+# MAX_LOAD_PER_CORE. How much memory a job takes at its peak is learned as jobs run, from how far this process'
+# resident memory grows above what it uses while idle. At least MIN_CONCURRENT_JOBS always run, so a busy machine still
+# makes progress, and never more than MAX_CONCURRENT_JOBS
+#
+# No single job can take more than its share either: what a job holds in this process is bounded by fetching tracks a
+# page at a time and by MAX_COVER_BYTES, and each drawing, the biggest part of a job, is bounded by the render engine's
+# RENDER_MEMORY_LIMIT
+#
+# Memory and load are read from /proc and os.getloadavg(), where those aren't available the cap is just
+# MAX_CONCURRENT_JOBS
+
+MIN_CONCURRENT_JOBS = 1
+MAX_CONCURRENT_JOBS = 4
+
+# What we expect a job to take before we've seen any, and the least we'll ever expect, in bytes
+JOB_MEMORY_ESTIMATE = 200 * 1024 * 1024
+MIN_JOB_MEMORY = 32 * 1024 * 1024
+
+# How much of the machine's memory is left for everything else
+MEMORY_RESERVE = 512 * 1024 * 1024
+
+# No new job starts while the one minute load average is above this many runnable processes per core
+MAX_LOAD_PER_CORE = 1.5
+
+# A bigger job than we expected raises the memory estimate straight away, smaller ones only bring it down by this much
+# of the difference each time we measure, so it stays near the peaks rather than the average
+ESTIMATE_DECAY = 0.01
+
+
+def available_memory():
+    # The memory the kernel says can be used without swapping, in bytes, or None if we can't tell
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def process_memory():
+    # This process' resident memory in bytes, or None if we can't tell
+    # The render engine's workers aren't counted, there's the same number of them however many jobs are running
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def load_per_core():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return None
+
+
+class AdmissionControl:
+    def __init__(self, min_jobs=MIN_CONCURRENT_JOBS, max_jobs=MAX_CONCURRENT_JOBS):
+        self.min_jobs = min_jobs
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+
+        # Jobs being made, and places kept for workers that are taking a job off the queue but haven't got one yet
+        self.running = 0
+        self.reserved = 0
+        self.job_memory = JOB_MEMORY_ESTIMATE
+
+        # This process' memory the last time it wasn't making any reports
+        self.idle_memory = None
+
+    def measure(self):
+        # Brings the idle memory or the memory per job up to date, and gives back the memory jobs are using now
+        memory = process_memory()
+        if memory is None:
+            return 0
+
+        if self.running == 0 or self.idle_memory is None:
+            self.idle_memory = memory
+            return 0
+
+        jobs_memory = max(0, memory - self.idle_memory)
+        per_job = jobs_memory / self.running
+        if per_job > self.job_memory:
+            self.job_memory = per_job
+        else:
+            self.job_memory = max(MIN_JOB_MEMORY, self.job_memory + ESTIMATE_DECAY * (per_job - self.job_memory))
+        return jobs_memory
+
+    def limit(self):
+        # How many jobs can run right now, and what's holding it there
+        jobs_memory = self.measure()
+
+        taken = self.running + self.reserved
+        if taken < self.min_jobs:
+            return self.min_jobs, "minimum"
+
+        load = load_per_core()
+        if load is not None and load > MAX_LOAD_PER_CORE:
+            return taken, "cpu"
+
+        available = available_memory()
+        if available is not None:
+            # The memory jobs have now plus what's free is what they can have between them. A job that's only just
+            # started hasn't used its share yet, which is why it's counted by the estimate rather than by what it uses
+            allowed = int((available + jobs_memory - MEMORY_RESERVE) // self.job_memory)
+            if allowed < self.max_jobs:
+                return max(allowed, self.min_jobs), "memory"
+
+        return self.max_jobs, "maximum"
+
+    def try_start(self):
+        # Called by a job worker before it takes a job, giving back True if there's room for one. The worker then
+        # calls started() if it got a job and finish() once that's done, or finish(started=False) if there wasn't one
+        # A place that's only kept counts towards the limit, but not towards the memory per job
+        with self.lock:
+            if self.running + self.reserved < self.limit()[0]:
+                self.reserved += 1
+                return True
+            return False
+
+    def started(self):
+        with self.lock:
+            self.reserved -= 1
+            self.running += 1
+
+    def finish(self, started=True):
+        with self.lock:
+            if started:
+                self.running -= 1
+            else:
+                self.reserved -= 1
+
+    def stats(self):
+        with self.lock:
+            limit, reason = self.limit()
+            return {
+                "running": self.running,
+                "reserved": self.reserved,
+                "limit": limit,
+                "limited_by": reason,
+                "job_memory": int(self.job_memory),
+                "available_memory": available_memory(),
+                "load_per_core": load_per_core(),
+            }
+
+
+_admission_control = None
+_admission_control_lock = threading.Lock()
+
+
+def get_admission_control():
+    # Every job worker in this process shares one
+    global _admission_control
+
+    with _admission_control_lock:
+        if _admission_control is None:
+            _admission_control = AdmissionControl()
+        return _admission_control
@@ -0,0 +1,178 @@
+import threading
+from collections import Counter, OrderedDict
+
+from sqlite_database import open_database
+
+# Popular albums turn up in a lot of people's playlists, and an album's release date never changes, so we keep every
+# album's release year we've ever been sent in one index shared by every report. It's an SQLite file so it's shared
+# between processes and survives restarts, with the most recently used albums also kept in memory in front of it.
+# The grabber adds every page of tracks it fetches, and anything that comes without a release date (a track fetched
+# with only its album's id) gets it filled in from here
+
+ALBUM_DB_PATH = "storage/album_years.sqlite3"
+
+# How many albums each process keeps in memory
+ALBUM_CACHE_SIZE = 50000
+
+# SQLite only takes so many ?s in one query, so lookups are done this many albums at a time
+LOOKUP_CHUNK = 500
+
+
+def create_tables(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS albums (
+                              album_id TEXT PRIMARY KEY,
+                              year INTEGER NOT NULL,
+                              precision TEXT)""")
+
+
+def year_from_release_date(release_date):
+    # The year of a release date, or None for a missing date or spotify's "0000"
+    if not isinstance(release_date, str) or not release_date[:4].isdigit():
+        return None
+    return int(release_date[:4]) or None
+
+
+class AlbumIndex:
+    def __init__(self, path=ALBUM_DB_PATH, cache_size=ALBUM_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+
+        # album id -> (year, release_date_precision), oldest first
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        # memory_hits and database_hits are albums we already knew when they were looked up, misses are ones we didn't,
+        # added is how many albums we've put in the index and filled is how many tracks got their year from it
+        self.counters = Counter()
+
+    def database(self):
+        # A connection to this index's file, used in a with block so it's closed afterwards
+        return open_database(self.path, create_tables)
+
+    def remember(self, albums):
+        # Puts albums in memory, dropping the least recently used ones once there are too many
+        with self.lock:
+            for album_id, album in albums.items():
+                self.memory[album_id] = album
+                self.memory.move_to_end(album_id)
+
+            while len(self.memory) > self.cache_size:
+                self.memory.popitem(last=False)
+
+    def lookup(self, album_ids):
+        # Gives back {album_id: (year, precision)} for the albums we know, looking in memory first
+        found = {}
+        missing = []
+
+        with self.lock:
+            for album_id in set(album_ids):
+                if album_id in self.memory:
+                    self.memory.move_to_end(album_id)
+                    found[album_id] = self.memory[album_id]
+                else:
+                    missing.append(album_id)
+
+            self.counters["memory_hits"] += len(found)
+
+        if not missing:
+            return found
+
+        from_database = {}
+        with self.database() as connection:
+            for start in range(0, len(missing), LOOKUP_CHUNK):
+                chunk = missing[start:start + LOOKUP_CHUNK]
+                rows = connection.execute(f"SELECT album_id, year, precision FROM albums "
+                                          f"WHERE album_id IN ({','.join('?' * len(chunk))})", chunk)
+                for album_id, year, precision in rows:
+                    from_database[album_id] = (year, precision)
+
+        self.remember(from_database)
+        found.update(from_database)
+
+        with self.lock:
+            self.counters["database_hits"] += len(from_database)
+            self.counters["misses"] += len(missing) - len(from_database)
+
+        return found
+
+    def add(self, albums):
+        # albums is {album_id: (year, precision)}
+        if not albums:
+            return
+
+        with self.database() as connection:
+            connection.executemany("INSERT OR REPLACE INTO albums (album_id, year, precision) VALUES (?, ?, ?)",
+                                   [(album_id, year, precision) for album_id, (year, precision) in albums.items()])
+
+        self.remember(albums)
+
+        with self.lock:
+            self.counters["added"] += len(albums)
+
+    def add_tracks(self, items):
+        # Adds the albums of a page of tracks, only writing the ones the index doesn't already have
+        albums = {}
+        for item in items:
+            try:
+                album = item["track"]["album"]
+                year = year_from_release_date(album["release_date"])
+                if album["id"] and year:
+                    albums[album["id"]] = (year, album.get("release_date_precision"))
+            except (KeyError, TypeError):
+                # Things like local files don't have an album
+                pass
+
+        known = self.lookup(albums)
+        self.add({album_id: album for album_id, album in albums.items() if album_id not in known})
+
+    def fill_release_dates(self, items):
+        # Tracks whose album came with an id but no release date get the year we have for that album, if we have one
+        missing = []
+        for item in items:
+            try:
+                album = item["track"]["album"]
+                if not album.get("release_date") and album.get("id"):
+                    missing.append(album)
+            except (KeyError, TypeError):
+                pass
+
+        if not missing:
+            return
+
+        known = self.lookup(album["id"] for album in missing)
+
+        filled = 0
+        for album in missing:
+            if album["id"] in known:
+                # We only fill in the year, so that's the precision the track ends up with
+                album["release_date"] = f"{known[album['id']][0]:04d}"
+                album["release_date_precision"] = "year"
+                filled += 1
+
+        with self.lock:
+            self.counters["filled"] += filled
+
+    def stats(self):
+        # The counters along with the hit rate, for seeing how often the index already knew an album
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cached_albums"] = len(self.memory)
+
+        hits = stats.get("memory_hits", 0) + stats.get("database_hits", 0)
+        lookups = hits + stats.get("misses", 0)
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+
+_album_index = None
+_album_index_lock = threading.Lock()
+
+
+def get_album_index():
+    # Every thread in this process shares one index, and so shares what it keeps in memory
+    global _album_index
+
+    with _album_index_lock:
+        if _album_index is None:
+            _album_index = AlbumIndex()
+        return _album_index
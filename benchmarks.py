@@ -0,0 +1,488 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+import requests
+
+# These are small timing scripts for the slow parts of making a report. They're run by hand, for example:
+# python benchmarks.py fetch --token <a spotify access token>
+
+from spotify_grabber import SpotifyGrabber, MAX_CONCURRENT_PLAYLISTS
+from playlist_analyser import DecadeHistogram, RENDER_SETTINGS
+from snapshot_store import SnapshotWriter, PlaylistSnapshot
+from fake_spotify import start_fake_spotify, DEFAULT_SETTINGS
+import album_index
+import json_codec
+import render_cache
+import render_engine
+
+
+def bench_fetch(token, max_workers=MAX_CONCURRENT_PLAYLISTS):
+    # Saving the same user's playlists twice, once one at a time like we used to and once with the thread pool
+    # Each run gets its own instance so they don't write over each other's folders, and its own empty render cache and
+    # album index, otherwise the second run would just copy everything the first one made
+
+    timings = {}
+    for workers in (1, max_workers):
+        with tempfile.TemporaryDirectory() as directory:
+            render_cache._cache = render_cache.RenderCache(os.path.join(directory, "render_cache"))
+            album_index._album_index = album_index.AlbumIndex(os.path.join(directory, "album_years.sqlite3"))
+
+            grabber = SpotifyGrabber()
+            grabber.token = token
+            timings[workers] = grabber.save_user_playlists(max_workers=workers)
+
+    render_cache._cache = None
+    album_index._album_index = None
+
+    sequential = timings[1]
+    concurrent = timings[max_workers]
+
+    print(f"sequential: {sequential:.2f}s")
+    print(f"{max_workers} workers: {concurrent:.2f}s")
+    print(f"speedup: {sequential / concurrent:.2f}x")
+
+
+def synthetic_tracks(n):
+    # Playlist track items with a mix of the three release date precisions spotify uses
+    items = []
+    for i in range(n):
+        year = random.randint(1950, 2023)
+        precision = random.choice(("day", "month", "year"))
+        date = {"day": f"{year}-03-14", "month": f"{year}-03", "year": f"{year}"}[precision]
+        items.append({"track": {"album": {"release_date": date, "release_date_precision": precision}}})
+    return items
+
+
+def synthetic_playlist(size):
+    # A whole playlist the way spotify sends it, with synthetic tracks padded out to about the size of real ones, since
+    # spotify's track objects have a lot more in them than just the album's release date
+    items = synthetic_tracks(size)
+    for item in items:
+        item["track"].update({"name": "A Track Name", "id": "x" * 22, "popularity": 50, "duration_ms": 215000,
+                              "artists": [{"name": "An Artist", "id": "y" * 22}], "available_markets": ["GB"] * 180})
+
+    return {"id": "z" * 22, "name": "Benchmark", "description": "", "snapshot_id": "s" * 32,
+            "external_urls": {"spotify": "https://open.spotify.com/playlist/benchmark"},
+            "tracks": {"total": size, "items": items}}
+
+
+def legacy_decade_counts(items):
+    # This is how PlaylistAnalyser used to count decades, one strptime per track and then a float pandas series
+    date_list = []
+    for track in items:
+        precision = track["track"]["album"]["release_date_precision"]
+        date = track["track"]["album"]["release_date"]
+
+        if precision == "day":
+            year = datetime.strptime(date, "%Y-%m-%d").year
+        elif precision == "month":
+            year = datetime.strptime(date, "%Y-%m").year
+        else:
+            year = date
+
+        date_list.append(year)
+
+    date_series = pd.Series(date_list).astype(float)
+    decades_series = (date_series / 10).astype(int)
+    return decades_series.value_counts().sort_index()
+
+
+def best_time(function, *args, repeats=5):
+    # The fastest of a few runs, which is the least affected by whatever else the machine is doing
+    timings = []
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def bench_decades(sizes=(1000, 10000, 100000)):
+    # Comparing the old per track decade counting with the vectorised DecadeHistogram on synthetic playlists
+
+    def vectorised_decade_counts(items):
+        histogram = DecadeHistogram()
+        histogram.add_tracks(items)
+        return histogram.counts
+
+    print(f"{'tracks':>8} {'legacy':>10} {'vectorised':>11} {'speedup':>8}")
+    for size in sizes:
+        items = synthetic_tracks(size)
+
+        legacy = best_time(legacy_decade_counts, items)
+        vectorised = best_time(vectorised_decade_counts, items)
+
+        print(f"{size:>8} {legacy * 1000:>8.1f}ms {vectorised * 1000:>9.1f}ms {legacy / vectorised:>7.1f}x")
+
+
+def bench_chart(repeats=5):
+    # Comparing the seaborn graph with the one pillow draws directly, both drawn in this process
+    render_engine.render_context.warm_up()
+
+    decade_counts = {1950: 4, 1960: 31, 1970: 58, 1980: 77, 1990: 64, 2000: 45, 2010: 92, 2020: 23}
+    dpi = RENDER_SETTINGS["graph_dpi"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'backend':>8} {'time':>9} {'size':>9}")
+        for backend, draw in render_engine.CHART_BACKENDS.items():
+            path = os.path.join(directory, f"{backend}.jpg")
+
+            # The first drawing loads fonts and warms caches, so it's left out of the timing
+            render_engine.render_to_files(path, None, draw, decade_counts, "Benchmark", dpi)
+            render_time = best_time(render_engine.render_to_files, path, None, draw, decade_counts, "Benchmark", dpi,
+                                    repeats=repeats)
+
+            print(f"{backend:>8} {render_time * 1000:>7.0f}ms {os.path.getsize(path) / 1024:>7.0f}KB")
+
+
+def bench_snapshot(size=10000, repeats=5):
+    # Comparing saving and loading a playlist as the whole JSON spotify sends with saving and loading its snapshot
+    playlist_data = synthetic_playlist(size)
+    items = playlist_data["tracks"]["items"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "data.json")
+        snapshot_path = os.path.join(directory, "snapshot.bin")
+
+        def write_json():
+            with open(json_path, "w") as f:
+                f.write(json.dumps(playlist_data))
+
+        def load_json():
+            with open(json_path, "r") as f:
+                histogram = DecadeHistogram()
+                histogram.add_tracks(json.load(f)["tracks"]["items"])
+
+        def write_snapshot():
+            writer = SnapshotWriter()
+            for start in range(0, size, 100):
+                writer.add_tracks(items[start:start + 100])
+            writer.write(snapshot_path, playlist_data)
+
+        def load_snapshot():
+            snapshot = PlaylistSnapshot(snapshot_path)
+            snapshot.decade_counts()
+
+        print(f"{'format':>9} {'write':>9} {'load':>9} {'size':>10}")
+        for name, write, load, path in (("data.json", write_json, load_json, json_path),
+                                        ("snapshot", write_snapshot, load_snapshot, snapshot_path)):
+            write_time = best_time(write, repeats=repeats)
+            load_time = best_time(load, repeats=repeats)
+            print(f"{name:>9} {write_time * 1000:>7.1f}ms {load_time * 1000:>7.2f}ms "
+                  f"{os.path.getsize(path) / 1024:>8.1f}KB")
+
+
+def bench_json(sizes=(100, 1000, 10000), repeats=5):
+    # Comparing the json module with json_codec (whichever library it found) on playlists the size spotify sends, and
+    # how much smaller they are gzipped on the wire. The json module's decode is timed the way response.json() does
+    # it, decoding the body into a string first
+    print(f"json_codec is using {json_codec.JSON_LIBRARY}")
+    print(f"{'tracks':>7} {'body':>9} {'gzipped':>9} {'json load':>10} {'codec load':>11} {'json dump':>10} "
+          f"{'codec dump':>11}")
+
+    for size in sizes:
+        playlist_data = synthetic_playlist(size)
+        body = json.dumps(playlist_data).encode("utf-8")
+        compressed = gzip.compress(body, compresslevel=6)
+
+        json_load = best_time(lambda: json.loads(body.decode("utf-8")), repeats=repeats)
+        codec_load = best_time(json_codec.loads, body, repeats=repeats)
+        json_dump = best_time(lambda: json.dumps(playlist_data).encode("utf-8"), repeats=repeats)
+        codec_dump = best_time(json_codec.dumps, playlist_data, repeats=repeats)
+
+        print(f"{size:>7} {len(body) / 1024:>7.0f}KB {len(compressed) / 1024:>7.0f}KB "
+              f"{json_load * 1000:>8.1f}ms {codec_load * 1000:>9.1f}ms {json_dump * 1000:>8.1f}ms "
+              f"{codec_dump * 1000:>9.1f}ms")
+
+
+def bench_cover(sizes=(640, 3000), repeats=5):
+    # Drawing a heading from downloaded cover art the way we used to (decode it, save it as a PNG, open the PNG again
+    # and paste it in at whatever size it was) and straight from the downloaded bytes
+    from PIL import Image
+
+    render_engine.render_context.warm_up()
+
+    with tempfile.TemporaryDirectory() as directory:
+        png_path = os.path.join(directory, "playlist_image.png")
+        jpg_path = os.path.join(directory, "playlist_image.jpg")
+
+        def legacy_heading(cover_data):
+            Image.open(io.BytesIO(cover_data)).save(png_path)
+            with Image.open(png_path) as cover:
+                cover.load()
+            heading = Image.new(cover.mode, (cover.width + 5300, cover.height + 1800), (255, 255, 255))
+            heading.paste(cover, (300, 1400))
+            return heading
+
+        def streamed_heading(cover_data):
+            with open(jpg_path, "wb") as f:
+                f.write(cover_data)
+            return render_engine.draw_final_image(cover_data, 0, "Benchmark", "")
+
+        print(f"{'cover':>6} {'legacy':>9} {'streamed':>9} {'legacy file':>12} {'kept file':>10}")
+        for size in sizes:
+            output = io.BytesIO()
+            Image.effect_noise((size, size), 64).convert("RGB").save(output, "JPEG", quality=85)
+            cover_data = output.getvalue()
+
+            legacy = best_time(legacy_heading, cover_data, repeats=repeats)
+            streamed = best_time(streamed_heading, cover_data, repeats=repeats)
+
+            print(f"{size:>6} {legacy * 1000:>7.0f}ms {streamed * 1000:>7.0f}ms "
+                  f"{os.path.getsize(png_path) / 1024:>10.0f}KB {os.path.getsize(jpg_path) / 1024:>8.0f}KB")
+
+
+def bench_startup(repeats=5):
+    # How long a fresh process takes to import the web app, and how long a process takes to get ready to draw the
+    # first time compared with every time after that
+
+    import_times = []
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, "-c",
+                                 "import time; start = time.perf_counter(); import flask_app; "
+                                 "print(time.perf_counter() - start)"],
+                                capture_output=True, text=True, check=True).stdout
+        import_times.append(float(output))
+
+    print(f"import flask_app: {min(import_times) * 1000:.0f}ms")
+
+    context = render_engine.RenderContext()
+    start_time = time.perf_counter()
+    context.warm_up()
+    first_setup = time.perf_counter() - start_time
+
+    reuse = best_time(context.warm_up, repeats=repeats)
+
+    print(f"render context first setup: {first_setup * 1000:.0f}ms")
+    print(f"render context after that: {reuse * 1000:.3f}ms")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree(root_pid):
+    # root_pid and every process started under it (the render engine's workers), found through /proc
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(children.get(pid, []))
+    return tree
+
+
+def process_usage(pid):
+    # (cpu seconds, resident bytes) for one process, from /proc/<pid>/stat
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu, int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class UsageSampler:
+    # Keeps track of the app's processes while the benchmark runs: the most memory they used at once, and their cpu
+    # time. Processes that end part way through keep the cpu time we last saw them with
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = {}
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        total_rss = 0
+        for pid in process_tree(self.pid):
+            try:
+                cpu, rss = process_usage(pid)
+            except (OSError, IndexError, ValueError):
+                continue
+            self.cpu[pid] = cpu
+            total_rss += rss
+        self.peak_rss = max(self.peak_rss, total_rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.start_cpu = sum(self.cpu.values())
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        return sum(self.cpu.values()) - self.start_cpu
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def simulate_user(app_url, user_number, timeout=600):
+    # One user going through the whole flow: logging in, the wait page, the job and then the report
+    # Gives back how long it took until the first playlist showed up on the report, how long until it was finished and
+    # the job's final status
+    session = requests.Session()
+    start_time = time.perf_counter()
+
+    # /get_user_auth sends us to spotify's login page, the state on it is our instance id
+    login = session.get(f"{app_url}/get_user_auth", allow_redirects=False)
+    login.raise_for_status()
+    instance_id = parse_qs(urlsplit(login.headers["Location"]).query)["state"][0]
+
+    # Logging in sends us back to /validate/ with an auth code, which the fake will take whatever it is
+    auth_code = f"code{user_number}"
+    session.get(f"{app_url}/validate/", params={"code": auth_code, "state": instance_id}).raise_for_status()
+    session.get(f"{app_url}/tasks/", params={"id": instance_id, "auth": auth_code},
+                allow_redirects=False).raise_for_status()
+    session.get(f"{app_url}/report/", params={"id": instance_id}).raise_for_status()
+
+    # Listening to the report's events like the report page does, reconnecting if the stream ends early
+    first_playlist = None
+    status = "timed out"
+    while status == "timed out" and time.perf_counter() - start_time < timeout:
+        with session.get(f"{app_url}/events/", params={"id": instance_id}, stream=True) as events:
+            event = None
+            for line in events.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: ") and event == "playlist" and first_playlist is None:
+                    first_playlist = time.perf_counter() - start_time
+                elif line.startswith("data: ") and event == "finished":
+                    status = json.loads(line[len("data: "):])["status"]
+
+    finished = time.perf_counter() - start_time
+    return first_playlist if first_playlist is not None else finished, finished, status
+
+
+def bench_load(users=8, concurrency=8, **fake_settings):
+    # Runs the web app in its own process against the fake spotify and sends users through it, concurrency at a time
+    # The app runs in a scratch folder so the benchmark's instances don't end up in this one
+    fake = start_fake_spotify(**fake_settings)
+    app_port = free_port()
+    app_url = f"http://127.0.0.1:{app_port}"
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.symlink(os.path.join(here, "fonts"), os.path.join(directory, "fonts"))
+        os.makedirs(os.path.join(directory, "static", "spotify_instances"))
+
+        environment = dict(os.environ, PYTHONPATH=here, SPOTIFY_ACCOUNTS_URL=fake.base_url,
+                           SPOTIFY_API_URL=f"{fake.base_url}/v1")
+        app = subprocess.Popen([sys.executable, "-c",
+                                f"import flask_app; flask_app.app.run(port={app_port}, threaded=True)"],
+                               cwd=directory, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            # Waiting for the app to start listening
+            for i in range(100):
+                try:
+                    requests.get(app_url, timeout=1)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+
+            sampler = UsageSampler(app.pid)
+            sampler.start()
+            start_time = time.perf_counter()
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(lambda number: simulate_user(app_url, number), range(users)))
+
+            elapsed = time.perf_counter() - start_time
+            cpu = sampler.stop()
+        finally:
+            for pid in reversed(process_tree(app.pid)):
+                try:
+                    os.kill(pid, 9)
+                except OSError:
+                    pass
+            app.wait()
+            fake.shutdown()
+
+    first_charts = [first_chart for first_chart, latency, status in results]
+    latencies = [latency for first_chart, latency, status in results]
+    finished = sum(status == "done" for first_chart, latency, status in results)
+
+    print(f"users: {users}, {concurrency} at a time, {finished} reports finished")
+    print(f"fake spotify: {fake.fake.requests} api requests, {fake.fake.rate_limited} rate limited")
+    print(f"throughput: {finished / elapsed * 60:.1f} reports/minute over {elapsed:.1f}s")
+    print(f"first chart: p50 {percentile(first_charts, 0.5):.2f}s, p99 {percentile(first_charts, 0.99):.2f}s")
+    print(f"report latency: p50 {percentile(latencies, 0.5):.2f}s, p99 {percentile(latencies, 0.99):.2f}s")
+    print(f"app cpu: {cpu:.1f}s ({cpu / elapsed:.0%} of one core)")
+    print(f"app peak rss: {sampler.peak_rss / 1024 / 1024:.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    fetch_parser = subparsers.add_parser("fetch", help="sequential vs concurrent playlist saving")
+    fetch_parser.add_argument("--token", required=True)
+    fetch_parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_PLAYLISTS)
+
+    subparsers.add_parser("decades", help="per track vs vectorised decade counting")
+    subparsers.add_parser("chart", help="seaborn vs pillow decade graph")
+    subparsers.add_parser("startup", help="web app import time and render context setup")
+    subparsers.add_parser("cover", help="heading from a saved and reopened PNG vs straight from the downloaded bytes")
+    subparsers.add_parser("snapshot", help="saving and loading a playlist as data.json vs snapshot.bin")
+    subparsers.add_parser("json", help="the json module vs json_codec, and gzipped sizes, on whole playlists")
+
+    load_parser = subparsers.add_parser("load", help="users going through the whole app against a fake spotify")
+    load_parser.add_argument("--users", type=int, default=8)
+    load_parser.add_argument("--concurrency", type=int, default=8)
+    for name, default in DEFAULT_SETTINGS.items():
+        if isinstance(default, bool):
+            load_parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+        else:
+            load_parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+
+    args = parser.parse_args()
+
+    if args.benchmark == "fetch":
+        bench_fetch(args.token, args.workers)
+    elif args.benchmark == "decades":
+        bench_decades()
+    elif args.benchmark == "chart":
+        bench_chart()
+    elif args.benchmark == "startup":
+        bench_startup()
+    elif args.benchmark == "snapshot":
+        bench_snapshot()
+    elif args.benchmark == "json":
+        bench_json()
+    elif args.benchmark == "cover":
+        bench_cover()
+    elif args.benchmark == "load":
+        bench_load(args.users, args.concurrency, **{name: getattr(args, name) for name in DEFAULT_SETTINGS})
@@ -0,0 +1,260 @@
+import argparse
+import gzip
+import io
+import itertools
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+import json_codec
+
+# A stand in for the parts of spotify the app uses, so the whole login -> report flow can be run and benchmarked
+# without a spotify account. It answers the accounts service's /authorize and /api/token, the web api's /me/playlists,
+# /playlists/{id} and /playlists/{id}/tracks, and serves cover art from /image/{id}. Point the app at it with:
+#   SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8900 SPOTIFY_API_URL=http://127.0.0.1:8900/v1 python flask_app.py
+#
+# Every user (access token) gets their own playlists unless shared_playlists is set, and a playlist's tracks are the
+# same every time it's asked for, so the render cache and album index behave like they do with real users
+
+DEFAULT_SETTINGS = {
+    # How long every request takes, in seconds, plus up to latency_jitter on top
+    "latency": 0.05,
+    "latency_jitter": 0.02,
+    # What each user has: how many playlists and how many tracks in each one, plus how many playlists made by spotify
+    # (which the app skips) come first in their list
+    "playlists": 8,
+    "spotify_playlists": 0,
+    "tracks": 250,
+    # Spotify pages tracks 100 at a time
+    "page_size": 100,
+    # The cover art is a square JPEG this many pixels wide
+    "image_size": 640,
+    # Track objects are padded out to about this many bytes when the request doesn't ask for only some fields,
+    # which is roughly what a real one weighs
+    "track_bytes": 2500,
+    # The chance any api request is answered with a 429, and the Retry-After it's sent with
+    "rate_limit_chance": 0.0,
+    "retry_after": 1,
+    # Like spotify, JSON responses are gzipped for clients that ask for it, at this level. 0 never compresses
+    "compress_level": 6,
+    # Every user gets the same playlists, so every report after the first can come from the render cache
+    "shared_playlists": False,
+}
+
+
+def playlist_tracks(playlist_id, count):
+    # The same tracks every time for the same playlist, drawn from a few hundred albums so popular albums repeat
+    generator = random.Random(playlist_id)
+
+    tracks = []
+    for i in range(count):
+        album = generator.randint(0, 499)
+        year = 1950 + album % 74
+        precision = ("day", "month", "year")[album % 3]
+        date = {"day": f"{year}-03-14", "month": f"{year}-03", "year": f"{year}"}[precision]
+        tracks.append({"album": {"id": f"album{album:05d}", "release_date": date, "release_date_precision": precision}})
+    return tracks
+
+
+class FakeSpotify:
+    def __init__(self, **settings):
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.base_url = None
+
+        self.tokens = itertools.count(1)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+
+        self.images = {}
+
+    def pause(self):
+        time.sleep(self.settings["latency"] + random.uniform(0, self.settings["latency_jitter"]))
+
+    def rate_limit(self):
+        # Decides whether this request gets a 429
+        limited = random.random() < self.settings["rate_limit_chance"]
+        with self.lock:
+            self.requests += 1
+            self.rate_limited += limited
+        return limited
+
+    def new_token(self):
+        with self.lock:
+            return f"token{next(self.tokens)}"
+
+    def user_playlists(self, token):
+        owner = "shared" if self.settings["shared_playlists"] else token
+        playlists = []
+        for i in range(self.settings["spotify_playlists"] + self.settings["playlists"]):
+            playlist_id = f"{owner}p{i}"
+            playlists.append({
+                "id": playlist_id,
+                "name": f"Playlist {i}",
+                "description": f"Fake playlist {i} for {owner}",
+                "snapshot_id": f"{playlist_id}snapshot",
+                "owner": {"display_name": "Spotify" if i < self.settings["spotify_playlists"] else owner},
+                "tracks": {"total": self.settings["tracks"]},
+                "images": [{"url": f"{self.base_url}/image/{playlist_id}"}],
+                "external_urls": {"spotify": f"{self.base_url}/playlist/{playlist_id}"},
+            })
+        return playlists
+
+    def track_page(self, playlist_id, offset, limit, trimmed):
+        total = self.settings["tracks"]
+        tracks = playlist_tracks(playlist_id, total)[offset:offset + limit]
+
+        if not trimmed:
+            padding = "x" * self.settings["track_bytes"]
+            tracks = [dict(track, name=f"Track {offset + i}", padding=padding) for i, track in enumerate(tracks)]
+
+        next_url = None
+        if offset + limit < total:
+            next_url = f"{self.base_url}/v1/playlists/{playlist_id}/tracks?" + urlencode({"offset": offset + limit,
+                                                                                         "limit": limit})
+        return {"items": [{"track": track} for track in tracks], "next": next_url, "total": total}
+
+    def image(self, image_id):
+        # Every cover is a flat colour, made once per colour and kept
+        from PIL import Image
+
+        colour = tuple(random.Random(image_id).randrange(256) for i in range(3))
+        with self.lock:
+            if colour not in self.images:
+                output = io.BytesIO()
+                size = self.settings["image_size"]
+                Image.new("RGB", (size, size), colour).save(output, "JPEG", quality=85)
+                self.images[colour] = output.getvalue()
+            return self.images[colour]
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Thousands of requests a second would drown out everything else
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        headers = dict(headers or {})
+        if not isinstance(body, bytes):
+            body = json_codec.dumps(body)
+
+        # Anything small isn't worth compressing, and the cover art is already compressed
+        compress_level = self.server.fake.settings["compress_level"]
+        if (compress_level and content_type == "application/json" and len(body) > 1024
+                and "gzip" in self.headers.get("Accept-Encoding", "")):
+            body = gzip.compress(body, compresslevel=compress_level)
+            headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+
+        fake.pause()
+
+        if urlsplit(self.path).path != "/api/token" or "code" not in form:
+            return self.send_body(400, {"error": "invalid_request"})
+
+        self.send_body(200, {"access_token": fake.new_token(), "token_type": "Bearer", "expires_in": 3600})
+
+    def do_GET(self):
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+        segments = parts.path.strip("/").split("/")
+
+        fake.pause()
+
+        if segments == ["authorize"]:
+            # The page the user would log in on, the app only needs its url
+            return self.send_body(200, b"<html>Log in to fake spotify</html>", "text/html")
+
+        if segments[0] == "image" and len(segments) == 2:
+            return self.send_body(200, fake.image(segments[1]), "image/jpeg")
+
+        if segments[0] != "v1":
+            return self.send_body(404, {"error": "not found"})
+
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+        if not token.startswith("token"):
+            return self.send_body(401, {"error": {"status": 401, "message": "Invalid access token"}})
+
+        if fake.rate_limit():
+            return self.send_body(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                  headers={"Retry-After": str(fake.settings["retry_after"])})
+
+        limit = int(query.get("limit", fake.settings["page_size"]))
+        offset = int(query.get("offset", 0))
+        trimmed = "fields" in query
+
+        if segments[1:] == ["me", "playlists"]:
+            # Spotify gives 20 at a time unless asked for up to 50
+            limit = min(int(query.get("limit", 20)), 50)
+            playlists = fake.user_playlists(token)
+
+            next_url = None
+            if offset + limit < len(playlists):
+                next_url = f"{fake.base_url}/v1/me/playlists?" + urlencode({"offset": offset + limit, "limit": limit})
+            return self.send_body(200, {"items": playlists[offset:offset + limit], "next": next_url,
+                                        "total": len(playlists)})
+
+        if segments[1] == "playlists" and len(segments) == 3:
+            playlist = next((playlist for playlist in fake.user_playlists(token) if playlist["id"] == segments[2]),
+                            None)
+            if playlist is None:
+                return self.send_body(404, {"error": {"status": 404, "message": "Not found"}})
+
+            playlist = dict(playlist, tracks=fake.track_page(segments[2], 0, fake.settings["page_size"], trimmed))
+            return self.send_body(200, playlist)
+
+        if segments[1] == "playlists" and segments[3:] == ["tracks"]:
+            return self.send_body(200, fake.track_page(segments[2], offset, min(limit, 100), trimmed))
+
+        self.send_body(404, {"error": {"status": 404, "message": "Not found"}})
+
+
+def start_fake_spotify(port=0, **settings):
+    # Starts the fake in a background thread, port 0 picks a free one. Gives back the server, whose base_url is where
+    # it's listening, call shutdown() on it to stop it
+    fake = FakeSpotify(**settings)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeSpotifyHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.base_url = fake.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    threading.Thread(target=server.serve_forever, name="fake-spotify", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake spotify for the app to talk to")
+    parser.add_argument("--port", type=int, default=8900)
+    for name, default in DEFAULT_SETTINGS.items():
+        if isinstance(default, bool):
+            parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+        else:
+            parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = vars(parser.parse_args())
+
+    port = args.pop("port")
+    server = start_fake_spotify(port, **args)
+    print(f"Fake spotify listening on {server.base_url}, "
+          f"set SPOTIFY_ACCOUNTS_URL={server.base_url} SPOTIFY_API_URL={server.base_url}/v1")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,22 +1,81 @@
-import json
+import hmac
 import os
+import time
+import job_queue
+import instance_registry
+import json_codec
+import metrics
+from admission import get_admission_control
+from album_index import get_album_index
 from spotify_grabber import SpotifyGrabber
+from playlist_analyser import render_variants
+from report_manifest import load_report_manifest, playlist_entry
+from snapshot_store import load_playlist_details
 
 # I decided not to publish my server name, if you want to use this code you'll need to replace this with your server
 SERVER_NAME = "https://replace_with_your_server_name.com"
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, render_template, request, redirect, jsonify, Response
+
+# The report's event stream looks for newly finished playlists at least this often (more often when they're finished
+# by this process), sends a comment every EVENTS_KEEPALIVE seconds so proxies don't close a quiet stream, and ends after
+# EVENTS_MAX_SECONDS. The browser reconnects by itself if the report still isn't finished
+EVENTS_POLL_SECONDS = 1.0
+EVENTS_KEEPALIVE = 15
+EVENTS_MAX_SECONDS = 300
+
+# /metrics/ is only shown to requests that send this token, as "Authorization: Bearer <token>" or ?token=<token>. The
+# app sits behind a reverse proxy, so every request looks like it comes from this machine and we can't go by address.
+# Without a token set /metrics/ is turned off
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
 
 app = Flask(__name__)
 
 
 def generate_spotify_review(auth_code, instance_id):
-    # Making a SpotifyGrabber object with this instance and letting it grab its token using our auth code
-    grabber = SpotifyGrabber(instance_id=instance_id)
-    grabber.request_token(auth_code)
+    # This runs on one of the job queue's worker threads rather than inside a request
+    # With metrics.TRACE_JOBS set every stage and request of the report is written to a trace file as well
+    trace = metrics.JobTrace(instance_id) if metrics.TRACE_JOBS else None
+
+    # The trace is written even if the report fails, that's when it's most useful
+    try:
+        with metrics.tracing(trace), metrics.timed("report"):
+            # Making a SpotifyGrabber object with this instance and letting it grab its token using our auth code
+            # If this job was interrupted after getting its token the grabber will already have it
+            grabber = SpotifyGrabber(instance_id=instance_id)
+            if grabber.token is None:
+                grabber.request_token(auth_code)
+
+            # This saves all the users playlist data files and images and produces all the graphs we want
+            # Every step for every playlist is recorded in the job queue so the wait page can show how far along it is
+            def progress(playlist_number, name, status):
+                job_queue.set_progress(instance_id, playlist_number, name, status)
+
+            grabber.save_user_playlists(progress=progress)
+    finally:
+        if trace is not None:
+            print(f"Report Trace Written: {trace.write()}")
+
+    # Now the report is finished we know how much space it takes up, which the registry needs to stay within budget
+    instance_registry.update_size(instance_id)
+
 
-    # This saves all the users playlist data files and images and produces all the graphs we want
-    grabber.save_user_playlists()
+def forget_instances(instance_ids):
+    # Called once the registry has deleted some old instances, their jobs go and so do any of their reports' manifests
+    # we're keeping in memory
+    job_queue.forget_jobs(instance_ids)
+    load_report_manifest.cache_clear()
+
+
+def start_background_threads():
+    # The job queue's workers and the thread that deletes old instances, both only start once per process
+    job_queue.start_workers(generate_spotify_review)
+    instance_registry.start_eviction(job_queue.busy_instances, forget_instances)
+
+
+# Started as soon as the app is loaded, so after a restart the jobs that were waiting or part way through are picked up
+# again straight away rather than the next time someone logs in
+start_background_threads()
 
 
 def generate_path_list(instance_id):
@@ -68,19 +127,112 @@ def recieve_spotify_code():
     return str(render_template('python_spotify_wait.html', param=param))
 
 
-# This is the route which produces the graphs and images that we need. Those tasks will be being performed whil the user
-# Is on the waiting page. The waiting page will be displaying a gif, this is an easy way to have the tasks look like
-# They're running in the background without needing to use javascript
+# This is the route which starts producing the graphs and images that we need. It puts a job on the job queue, which
+# makes the report in the background, and sends the user straight on to the report page, where each playlist shows up
+# as soon as it's ready
 @app.route('/tasks/')
 def do_tasks():
     instance_id = request.args.get("id")
     auth_code = request.args.get("auth")
 
-    param = f"?id={instance_id}"
+    job_queue.enqueue(instance_id, auth_code)
+
+    return redirect(f"{SERVER_NAME}/report/?id={instance_id}")
+
+
+# The waiting page polls this to see how the user's report is getting on, it gives the job's status and the status of
+# every playlist in it
+@app.route('/status/')
+def job_status():
+    instance_id = request.args.get("id")
+
+    status = job_queue.get_status(instance_id)
+    if status is None:
+        return jsonify({"status": "unknown"}), 404
+
+    return jsonify(status)
+
+
+# Timings for every stage of making reports and request counts, bytes and latencies for every spotify endpoint, since
+# this process started. They're only shown to requests with the METRICS_TOKEN
+@app.route('/metrics/')
+def show_metrics():
+    if not METRICS_TOKEN:
+        return jsonify({"error": "metrics are turned off"}), 404
+
+    token = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        return jsonify({"error": "metrics need a token"}), 403
+
+    process_metrics = metrics.metrics.to_dict()
+    process_metrics["album_index"] = get_album_index().stats()
+    process_metrics["admission"] = get_admission_control().stats()
+    return jsonify(process_metrics)
+
+
+def finished_playlists(instance_id, status, skip=()):
+    # The report page entries of the playlists in the job's status that are finished and have their images, leaving
+    # out the numbers in skip without looking at their files
+    widths, image_format = render_variants()
+
+    entries = []
+    for playlist in status["playlists"]:
+        if playlist["status"] in ("done", "cached") and playlist["playlist_number"] not in skip:
+            entry = playlist_entry(instance_id, playlist["playlist_number"], widths, image_format)
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json_codec.dumps(data).decode()}\n\n"
 
-    generate_spotify_review(auth_code, instance_id)
 
-    return redirect(f"{SERVER_NAME}/report/{param}")
+def report_events(instance_id):
+    # Sends a playlist event for every playlist as soon as it's finished, a progress event whenever the count changes
+    # and a finished event once the whole job is over. A browser that reconnects is sent everything again, the report
+    # page ignores playlists it already has
+    sent = set()
+    last_progress = None
+    start_time = last_sent = time.monotonic()
+
+    while time.monotonic() - start_time < EVENTS_MAX_SECONDS:
+        status = job_queue.get_status(instance_id)
+        if status is None:
+            yield server_sent_event("finished", {"status": "unknown"})
+            return
+
+        for entry in finished_playlists(instance_id, status, skip=sent):
+            sent.add(entry["number"])
+            yield server_sent_event("playlist", entry)
+            last_sent = time.monotonic()
+
+        progress = {"status": status["status"], "position": status["position"],
+                    "finished_playlists": status["finished_playlists"], "total": status["total"]}
+        if progress != last_progress:
+            last_progress = progress
+            yield server_sent_event("progress", progress)
+            last_sent = time.monotonic()
+
+        if status["status"] in ("done", "failed"):
+            yield server_sent_event("finished", {"status": status["status"]})
+            return
+
+        if time.monotonic() - last_sent > EVENTS_KEEPALIVE:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+
+        job_queue.wait_for_progress(EVENTS_POLL_SECONDS)
+
+
+# The report page listens to this while the report is being made, it streams each playlist as it's finished
+@app.route('/events/')
+def stream_report_events():
+    instance_id = request.args.get("id")
+
+    return Response(report_events(instance_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 # This function generates a dictionary of the links to the playlists that the user has
 def generate_link_dict(instance_id, path_list):
@@ -88,20 +240,67 @@ def generate_link_dict(instance_id, path_list):
 
     for playlist in path_list:
         link_dict[playlist] = f"{SERVER_NAME}/static/spotify_instances/{playlist}/playlist_image.png"
-        with open(f"static/spotify_instances/{playlist}/data.json", "r+") as f:
-            data = json.load(f)
-            link_dict[playlist] = data["external_urls"]["spotify"]
+        link_dict[playlist] = load_playlist_details(f"static/spotify_instances/{playlist}")["link"]
     return link_dict
 
-# Once the tasks are finished users are sent here. The user instance id's are designed in such a way that they are
-# random and will never repeat, and this page only takes the id and assigns to the HTML page the associated images
+
+# Playlists drawn before we started making smaller copies of the images don't have them, so the report only gives those
+# copies to the browser for the playlists that have them
+def generate_variant_set(path_list):
+    widths, image_format = render_variants()
+
+    return {playlist for playlist in path_list
+            if os.path.exists(f"static/spotify_instances/{playlist}/graph_{widths[0]}.{image_format}")}
+
+
+# Users are sent here as soon as their report's job is queued, and its playlists show up one by one as they're
+# finished. The user instance id's are designed in such a way that they are random and will never repeat, and this page
+# only takes the id and assigns to the HTML page the associated images
 # So this page can be refreshed without any
 
 
 @app.route('/report/')
 def show_report():
     instance_id = request.args.get("id")
-    path_list = generate_path_list(instance_id)
-    link_dict = generate_link_dict(instance_id, path_list)
 
-    return str(render_template('python_spotify_end.html', path_list=path_list, link_dict=link_dict))
+    # Keeping the report from being deleted while people are still looking at it
+    instance_registry.touch_instance(instance_id)
+
+    # Finished reports have a manifest with everything we need, which is usually already in memory
+    # Reports made before we wrote manifests are put together from their folders like they always were
+    try:
+        manifest = load_report_manifest(instance_id)
+
+        path_list = [playlist["path"] for playlist in manifest["playlists"]]
+        link_dict = {playlist["path"]: playlist["link"] for playlist in manifest["playlists"]}
+        variant_set = {playlist["path"] for playlist in manifest["playlists"] if playlist["variants"]}
+        variant_widths = manifest["variant_widths"]
+        variant_format = manifest["variant_format"]
+
+        live = False
+        position = None
+
+    except FileNotFoundError:
+        status = job_queue.get_status(instance_id)
+        variant_widths, variant_format = render_variants()
+
+        # While the report is still being made we show the playlists that are finished so far, the page then listens
+        # to /events/ for the rest
+        live = status is not None and status["status"] not in ("done", "failed")
+        position = status["position"] if live else None
+
+        if live:
+            playlists = finished_playlists(instance_id, status)
+
+            path_list = [playlist["path"] for playlist in playlists]
+            link_dict = {playlist["path"]: playlist["link"] for playlist in playlists}
+            variant_set = {playlist["path"] for playlist in playlists if playlist["variants"]}
+
+        else:
+            path_list = generate_path_list(instance_id)
+            link_dict = generate_link_dict(instance_id, path_list)
+            variant_set = generate_variant_set(path_list)
+
+    return str(render_template('python_spotify_end.html', path_list=path_list, link_dict=link_dict,
+                               variant_set=variant_set, variant_widths=variant_widths, variant_format=variant_format,
+                               live=live, position=position, instance_id=instance_id))
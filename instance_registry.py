@@ -0,0 +1,214 @@
+import os
+import secrets
+import shutil
+import sqlite3
+import string
+import threading
+import time
+import traceback
+
+from render_cache import directory_size
+from sqlite_database import open_database
+
+# Every instance (one user's report) is recorded here when it's made, along with when it was made, when its report was
+# last looked at and how much space it takes up. New instance ids come from a counter in the same database, so making
+# one never has to look through the instances folder. Old instances are deleted by a background thread rather than on
+# the way to someone's login: reports nobody has looked at for INSTANCE_TTL go first, and then the least recently
+# looked at ones while the instances take up more than INSTANCE_DISK_BUDGET. Reports that are still being made are
+# never deleted
+
+INSTANCE_DB_PATH = "storage/instances.sqlite3"
+INSTANCES_PATH = "static/spotify_instances"
+
+INSTANCE_TTL = 7 * 24 * 60 * 60
+INSTANCE_DISK_BUDGET = 10 * 1024 * 1024 * 1024
+
+# An instance is made when the user is sent off to spotify to log in, before it has a job, so an instance this new is
+# never deleted even if we're over budget
+MIN_INSTANCE_AGE = 60 * 60
+
+# How often the background thread looks for instances to delete, in seconds
+EVICTION_INTERVAL = 10 * 60
+
+# Looking at a report only updates its last accessed time if it hasn't been updated for this long, so showing a
+# report doesn't write to the database every time
+ACCESS_RESOLUTION = 60 * 60
+
+
+def database():
+    # The registry's tables (and the counter, the first time there's a registry at all) are made when it's first opened
+    return open_database(INSTANCE_DB_PATH, create_tables)
+
+
+def create_tables(connection):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("""CREATE TABLE IF NOT EXISTS instances (
+                                  instance_id TEXT PRIMARY KEY,
+                                  number INTEGER NOT NULL,
+                                  created REAL NOT NULL,
+                                  last_accessed REAL NOT NULL,
+                                  size INTEGER NOT NULL DEFAULT 0)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS instances_by_access ON instances (last_accessed)")
+
+        connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+        # The first time the registry is made we add the instances that are already there, and start the counter
+        # after the biggest one so ids keep climbing like they always have
+        if connection.execute("SELECT value FROM counters WHERE name = 'instance'").fetchone() is None:
+            register_existing_instances(connection)
+
+        connection.execute("COMMIT")
+    except sqlite3.Error:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def register_existing_instances(connection):
+    highest = 0
+
+    if os.path.isdir(INSTANCES_PATH):
+        for entry in os.scandir(INSTANCES_PATH):
+            try:
+                number = int(entry.name.split("_")[0])
+            except ValueError:
+                continue
+
+            modified = entry.stat().st_mtime
+            connection.execute("""INSERT OR IGNORE INTO instances (instance_id, number, created, last_accessed, size)
+                                  VALUES (?, ?, ?, ?, ?)""",
+                               (entry.name, number, modified, modified, directory_size(entry.path)))
+            highest = max(highest, number)
+
+    connection.execute("INSERT INTO counters (name, value) VALUES ('instance', ?)", (highest,))
+
+
+def create_instance():
+    # Our instance id's begin with an order number and then have a sequence of 10 random characters afterward
+    # The order number will climb indefinitely, so it will reference what instance the user was totally
+    # The order number and the random characters are separated by a '_'
+    # BEGIN IMMEDIATE means two logins at the same moment (even in different processes) never get the same number
+    id_alphabet = string.ascii_letters + string.digits
+    random_part = "".join(secrets.choice(id_alphabet) for i in range(10))
+
+    now = time.time()
+
+    with database() as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'instance'")
+            number = connection.execute("SELECT value FROM counters WHERE name = 'instance'").fetchone()["value"]
+
+            instance_id = f"{number}_{random_part}"
+            connection.execute("""INSERT INTO instances (instance_id, number, created, last_accessed)
+                                  VALUES (?, ?, ?, ?)""", (instance_id, number, now, now))
+
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+    return instance_id
+
+
+_last_touched = {}
+_last_touched_lock = threading.Lock()
+
+
+def touch_instance(instance_id):
+    # Records that the instance's report was looked at, at most once every ACCESS_RESOLUTION
+    now = time.time()
+
+    with _last_touched_lock:
+        if now - _last_touched.get(instance_id, 0) < ACCESS_RESOLUTION:
+            return
+        _last_touched[instance_id] = now
+
+    with database() as connection:
+        connection.execute("UPDATE instances SET last_accessed = ? WHERE instance_id = ?", (now, instance_id))
+
+
+def update_size(instance_id, accessed=True):
+    # Measures how much space the instance takes up now, this is done once its report is finished. Something other
+    # than a report being made (like rerender.py) passes accessed=False so the instance doesn't look freshly used
+    path = os.path.join(INSTANCES_PATH, instance_id)
+    if not os.path.isdir(path):
+        return
+
+    with database() as connection:
+        if accessed:
+            connection.execute("UPDATE instances SET size = ?, last_accessed = ? WHERE instance_id = ?",
+                               (directory_size(path), time.time(), instance_id))
+        else:
+            connection.execute("UPDATE instances SET size = ? WHERE instance_id = ?",
+                               (directory_size(path), instance_id))
+
+
+def delete_instance(instance_id):
+    shutil.rmtree(os.path.join(INSTANCES_PATH, instance_id), ignore_errors=True)
+
+    with database() as connection:
+        connection.execute("DELETE FROM instances WHERE instance_id = ?", (instance_id,))
+
+    with _last_touched_lock:
+        _last_touched.pop(instance_id, None)
+
+
+def evict_instances(busy_instances=()):
+    # Deletes expired instances and then the least recently looked at ones until we're under budget, leaving alone
+    # anything in busy_instances and anything made in the last MIN_INSTANCE_AGE. Gives back the deleted instance ids
+    now = time.time()
+    busy_instances = set(busy_instances)
+
+    with database() as connection:
+        instances = connection.execute("""SELECT instance_id, created, last_accessed, size FROM instances
+                                          ORDER BY last_accessed""").fetchall()
+
+    total_size = sum(instance["size"] for instance in instances)
+    evicted = []
+
+    for instance in instances:
+        if instance["instance_id"] in busy_instances or now - instance["created"] < MIN_INSTANCE_AGE:
+            continue
+
+        expired = now - instance["last_accessed"] > INSTANCE_TTL
+        if not expired and total_size <= INSTANCE_DISK_BUDGET:
+            # Everything after this was looked at more recently, so it isn't expired either
+            break
+
+        delete_instance(instance["instance_id"])
+        total_size -= instance["size"]
+        evicted.append(instance["instance_id"])
+
+    return evicted
+
+
+_eviction_thread = None
+_eviction_lock = threading.Lock()
+
+
+def eviction_loop(busy_instances, on_evicted):
+    while True:
+        try:
+            evicted = evict_instances(busy_instances())
+            if evicted:
+                print(f"{len(evicted)} Instances Deleted: {', '.join(evicted)}")
+                on_evicted(evicted)
+        except (sqlite3.Error, OSError):
+            traceback.print_exc()
+
+        time.sleep(EVICTION_INTERVAL)
+
+
+def start_eviction(busy_instances, on_evicted):
+    # Starts the thread that deletes old instances. busy_instances() gives the instances that mustn't be deleted right
+    # now and on_evicted(instance_ids) is called after some have been. Calling this again does nothing
+    global _eviction_thread
+
+    with _eviction_lock:
+        if _eviction_thread is not None:
+            return
+
+        _eviction_thread = threading.Thread(target=eviction_loop, args=(busy_instances, on_evicted),
+                                            name="instance-eviction", daemon=True)
+        _eviction_thread.start()
@@ -0,0 +1,264 @@
+import sqlite3
+import threading
+import time
+import traceback
+
+from admission import get_admission_control, MAX_CONCURRENT_JOBS
+from sqlite_database import open_database
+
+# Making a report takes a while, so instead of doing it inside the /tasks/ request we put a job in this queue and a
+# few worker threads pick jobs up and run them. The queue lives in an SQLite file rather than in memory, so a job
+# that was waiting, or was halfway through when the server restarted, is picked up again afterwards
+
+JOB_DB_PATH = "storage/jobs.sqlite3"
+
+# How many worker threads each server process has. This is the most reports it will make at once, admission control
+# decides how many it actually does given the memory and cpu it has free
+WORKER_COUNT = MAX_CONCURRENT_JOBS
+
+# A worker holds a lease on its job and keeps renewing it while the job runs. If the lease runs out the worker must
+# have died (usually because the server restarted), so the job goes back to the queue, up to MAX_ATTEMPTS times
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+
+# How long an idle worker waits before looking at the queue again, in seconds
+POLL_INTERVAL = 1.0
+
+
+def database():
+    # WAL mode means the status page can read while a worker is writing
+    return open_database(JOB_DB_PATH, create_tables)
+
+
+def create_tables(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                              instance_id TEXT PRIMARY KEY,
+                              auth_code TEXT,
+                              status TEXT NOT NULL,
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              created REAL NOT NULL,
+                              started REAL,
+                              finished REAL,
+                              lease_until REAL,
+                              error TEXT)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created)")
+
+    connection.execute("""CREATE TABLE IF NOT EXISTS progress (
+                              instance_id TEXT NOT NULL,
+                              playlist_number INTEGER NOT NULL,
+                              name TEXT,
+                              status TEXT NOT NULL,
+                              updated REAL NOT NULL,
+                              PRIMARY KEY (instance_id, playlist_number))""")
+
+
+def enqueue(instance_id, auth_code):
+    # Adds a job for this instance. The wait page can ask more than once, so asking again for an instance that already
+    # has a job does nothing
+    with database() as connection:
+        connection.execute("INSERT OR IGNORE INTO jobs (instance_id, auth_code, status, created) VALUES (?, ?, ?, ?)",
+                           (instance_id, auth_code, "queued", time.time()))
+
+    _wake_workers.set()
+
+
+def claim_job():
+    # Takes the oldest job that's waiting, or whose worker has gone quiet, and leases it to the caller
+    # BEGIN IMMEDIATE stops two workers (even in different processes) from claiming the same job
+    now = time.time()
+
+    with database() as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            job = connection.execute("""SELECT instance_id, auth_code, attempts FROM jobs
+                                        WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+                                        ORDER BY created LIMIT 1""", (now,)).fetchone()
+
+            if job is not None and job["attempts"] >= MAX_ATTEMPTS:
+                connection.execute("""UPDATE jobs SET status = 'failed', finished = ?, error = ?, auth_code = NULL
+                                      WHERE instance_id = ?""",
+                                   (now, "worker stopped too many times", job["instance_id"]))
+                job = None
+
+            elif job is not None:
+                connection.execute("""UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?,
+                                      lease_until = ? WHERE instance_id = ?""",
+                                   (now, now + LEASE_SECONDS, job["instance_id"]))
+
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+    return dict(job) if job is not None else None
+
+
+def renew_lease(instance_id):
+    with database() as connection:
+        connection.execute("UPDATE jobs SET lease_until = ? WHERE instance_id = ? AND status = 'running'",
+                           (time.time() + LEASE_SECONDS, instance_id))
+
+
+def finish_job(instance_id, error=None):
+    # The auth code can't be used again so we don't keep it once the job is over
+    with database() as connection:
+        connection.execute("""UPDATE jobs SET status = ?, finished = ?, error = ?, auth_code = NULL, lease_until = NULL
+                              WHERE instance_id = ?""",
+                           ("failed" if error else "done", time.time(), error, instance_id))
+
+    notify_progress()
+
+
+def set_progress(instance_id, playlist_number, name, status):
+    with database() as connection:
+        connection.execute("""INSERT INTO progress (instance_id, playlist_number, name, status, updated)
+                              VALUES (?, ?, ?, ?, ?)
+                              ON CONFLICT (instance_id, playlist_number)
+                              DO UPDATE SET name = excluded.name, status = excluded.status, updated = excluded.updated""",
+                           (instance_id, playlist_number, name, status, time.time()))
+
+    notify_progress()
+
+
+# Anyone following a job's progress (the report page's event stream) waits on this, so they hear about a playlist
+# being finished by this process straight away rather than the next time they look
+_progress_changed = threading.Condition()
+
+
+def notify_progress():
+    with _progress_changed:
+        _progress_changed.notify_all()
+
+
+def wait_for_progress(timeout):
+    # Waits until a job in this process makes progress, or until timeout seconds have passed. Jobs run by other
+    # processes don't wake us up, so after waiting the caller should look at the database either way
+    with _progress_changed:
+        _progress_changed.wait(timeout)
+
+
+def get_status(instance_id):
+    # Everything the wait page needs to know about a job, or None if there isn't one for this instance
+    with database() as connection:
+        job = connection.execute("SELECT status, created, started, finished, error FROM jobs WHERE instance_id = ?",
+                                 (instance_id,)).fetchone()
+        if job is None:
+            return None
+
+        playlists = connection.execute("""SELECT playlist_number, name, status FROM progress WHERE instance_id = ?
+                                          ORDER BY playlist_number""", (instance_id,)).fetchall()
+
+        # Where a waiting job is in the queue, 1 means it's next
+        position = None
+        if job["status"] == "queued":
+            position = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created <= ?",
+                                          (job["created"],)).fetchone()[0]
+
+    playlists = [dict(playlist) for playlist in playlists]
+
+    status = dict(job)
+    status["position"] = position
+    status["playlists"] = playlists
+    status["total"] = len(playlists)
+    status["finished_playlists"] = sum(playlist["status"] in ("done", "cached", "failed") for playlist in playlists)
+    return status
+
+
+def busy_instances():
+    # The instances whose reports are waiting to be made or being made right now
+    with database() as connection:
+        rows = connection.execute("SELECT instance_id FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+
+    return {row["instance_id"] for row in rows}
+
+
+def forget_jobs(instance_ids):
+    # Removes everything we know about these instances' jobs, for when the instances themselves have been deleted
+    with database() as connection:
+        for instance_id in instance_ids:
+            connection.execute("DELETE FROM jobs WHERE instance_id = ?", (instance_id,))
+            connection.execute("DELETE FROM progress WHERE instance_id = ?", (instance_id,))
+
+
+_wake_workers = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def run_job(job, function):
+    # Runs one job, renewing its lease in the background for as long as it takes
+    instance_id = job["instance_id"]
+    stop_renewing = threading.Event()
+
+    def keep_lease():
+        # A renewal that fails (the database being locked for longer than we wait, say) is tried again next time
+        # round, stopping would let another worker take the job while it's still running here
+        while not stop_renewing.wait(LEASE_SECONDS / 3):
+            try:
+                renew_lease(instance_id)
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    renewer = threading.Thread(target=keep_lease, daemon=True)
+    renewer.start()
+
+    try:
+        function(job["auth_code"], instance_id)
+        finish_job(instance_id)
+        print(f"Job Finished, Instance: {instance_id}")
+    except Exception:
+        traceback.print_exc()
+        finish_job(instance_id, error=traceback.format_exc(limit=3))
+        print(f"Job Failed, Instance: {instance_id}")
+    finally:
+        stop_renewing.set()
+
+
+def worker_loop(function):
+    admission = get_admission_control()
+
+    while True:
+        # A worker only takes a job if admission control says there's room for another one, otherwise the job stays
+        # in the queue until a running one finishes or the machine is less busy
+        if not admission.try_start():
+            _wake_workers.wait(POLL_INTERVAL)
+            _wake_workers.clear()
+            continue
+
+        try:
+            job = claim_job()
+        except sqlite3.Error:
+            traceback.print_exc()
+            job = None
+
+        if job is None:
+            admission.finish(started=False)
+            _wake_workers.wait(POLL_INTERVAL)
+            _wake_workers.clear()
+            continue
+
+        # Nothing a job does should stop the worker, even failing to record how the job went, there's nothing to
+        # start a new worker in its place
+        admission.started()
+        try:
+            run_job(job, function)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            admission.finish()
+
+        # Any worker that was held back can try again now there's room
+        _wake_workers.set()
+
+
+def start_workers(function, count=WORKER_COUNT):
+    # Starts the worker threads for this process, they call function(auth_code, instance_id) for every job
+    # Calling this again does nothing, so it's safe to call whenever a job is added
+    with _workers_lock:
+        if _workers:
+            return
+
+        for i in range(count):
+            worker = threading.Thread(target=worker_loop, args=(function,), name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
@@ -0,0 +1,51 @@
+import json
+
+# The JSON we read from spotify (a page of tracks, a playlist) and write for ourselves (manifests, playlist lists,
+# snapshot headers) goes through here, so the quickest JSON library that's installed is used for all of it: orjson if
+# it's there, then ujson, then the json module that comes with python. They all give back the same objects, so
+# nothing else needs to know which one it got
+#
+# dumps gives back bytes whichever library it is, which can go straight into a file opened with "wb" or a response,
+# and loads takes bytes or a string, so a response's body never has to be decoded into a string first
+
+try:
+    import orjson
+
+    JSON_LIBRARY = "orjson"
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+except ImportError:
+    try:
+        import ujson
+
+        JSON_LIBRARY = "ujson"
+
+        def loads(data):
+            return ujson.loads(data)
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+    except ImportError:
+        JSON_LIBRARY = "json"
+
+        def loads(data):
+            return json.loads(data)
+
+        def dumps(obj):
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def load(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def dump(obj, path):
+    with open(path, "wb") as f:
+        f.write(dumps(obj))
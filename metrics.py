@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+# Timings for every stage of making a report and counts, bytes and latencies for every spotify endpoint we call, kept
+# for the life of the process and shown by /metrics/. A report can also write a trace file with every stage and
+# request it went through in order, which is the easiest way to see where one slow report spent its time
+
+# The upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Set this to write a trace file for every report into TRACE_PATH
+TRACE_JOBS = False
+TRACE_PATH = "storage/traces"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        # The buckets are cumulative like prometheus', each one counts everything that took at most that long
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.bucket_counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {"count": self.count, "total": round(self.total, 6), "max": round(self.max, 6),
+                "mean": round(self.total / self.count, 6) if self.count else 0.0, "buckets": buckets}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.endpoints = {}
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def record_request(self, endpoint, status, seconds, size):
+        # status is the response's status code, or the name of the exception if there wasn't a response
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = {"requests": 0, "bytes": 0, "statuses": Counter(), "latency": Histogram()}
+
+            entry = self.endpoints[endpoint]
+            entry["requests"] += 1
+            entry["bytes"] += size
+            entry["statuses"][str(status)] += 1
+            entry["latency"].observe(seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "stages": {stage: histogram.to_dict() for stage, histogram in sorted(self.stages.items())},
+                "endpoints": {endpoint: {"requests": entry["requests"], "bytes": entry["bytes"],
+                                         "statuses": dict(entry["statuses"]), "latency": entry["latency"].to_dict()}
+                              for endpoint, entry in sorted(self.endpoints.items())},
+            }
+
+
+class JobTrace:
+    # Every stage and request of one report, in the order they finished
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.started = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, seconds, **details):
+        event = {"at": round(time.perf_counter() - self.started - seconds, 6), kind: name,
+                 "seconds": round(seconds, 6), "thread": threading.current_thread().name}
+        event.update(details)
+
+        with self.lock:
+            self.events.append(event)
+
+    def write(self):
+        os.makedirs(TRACE_PATH, exist_ok=True)
+        path = os.path.join(TRACE_PATH, f"{self.instance_id}.json")
+
+        with self.lock:
+            trace = {"instance_id": self.instance_id, "seconds": round(time.perf_counter() - self.started, 6),
+                     "events": sorted(self.events, key=lambda event: event["at"])}
+
+        with open(path, "w") as f:
+            json.dump(trace, f, indent=1)
+
+        return path
+
+
+metrics = Metrics()
+
+# The trace of the report the current thread is working on, if it's being traced
+_current = threading.local()
+
+
+def current_trace():
+    return getattr(_current, "trace", None)
+
+
+@contextmanager
+def tracing(trace):
+    # Everything timed on this thread inside the with block is added to trace as well, trace can be None
+    previous = current_trace()
+    _current.trace = trace
+    try:
+        yield trace
+    finally:
+        _current.trace = previous
+
+
+def record_stage(stage, seconds, **details):
+    metrics.record_stage(stage, seconds)
+
+    trace = current_trace()
+    if trace is not None:
+        trace.record("stage", stage, seconds, **details)
+
+
+def record_request(endpoint, status, seconds, size):
+    metrics.record_request(endpoint, status, seconds, size)
+
+    trace = current_trace()
+    if trace is not None:
+        trace.record("request", endpoint, seconds, status=status, bytes=size)
+
+
+@contextmanager
+def timed(stage, **details):
+    # Times the with block as one run of stage, whether or not it raises
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time, **details)
@@ -1,170 +1,205 @@
-import matplotlib
-
-# This is needed because we are only using this file in threads and not in a main loop
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
-from PIL import Image, ImageFont, ImageDraw
+import hashlib
 import json
-import pandas as pd
-import matplotlib
-import seaborn as sb
-from datetime import datetime
-from matplotlib.font_manager import fontManager, FontProperties
-
-# Defining some fonts
-big_font = ImageFont.truetype("fonts/GothamBold.ttf", 100, encoding="unic")
-medium_font = ImageFont.truetype("fonts/GothamMedium.ttf", 150, encoding="unic")
-small_font = ImageFont.truetype("fonts/GothamMedium.ttf", 100, encoding="unic")
-tiny_font = ImageFont.truetype("fonts/GothamLight.ttf", 80, encoding="unic")
-
-
-class PlaylistAnalyser:
-    def __init__(self, instance_id, playlist_num):
-        # This prevents graphs from saving on top of each other
-        plt.clf()
-
-        # Adds the user and the playlist as attributes
-        self.instance_id = instance_id
-        self.playlist_num = playlist_num
-
-        # Getting the playlist data as an attribute
-        with open(f"static/spotify_instances/{self.instance_id}/playlist{self.playlist_num}/data.json",
-                  "r+") as instance_file:
-            self.playlist_data = json.load(instance_file)
-
-        # Setting the playlists name as an attribute
-        self.playlist_name = self.playlist_data["name"]
-        self.playlist_description = self.playlist_data["description"]
-        self.link = self.playlist_data["external_urls"]["spotify"]
+import os
+from collections import Counter
 
-        # Adding a spotify-esque font and setting seaborn style for the inevitable graphs
+from album_index import get_album_index
+from metrics import record_stage, timed
+from render_engine import get_render_engine
 
-        path = "fonts/GothamMedium.ttf"
-        fontManager.addfont(path)
+# Everything that changes how the graphs and headings look. These are part of the render cache key, so changing any
+# of them (or bumping the version after changing the drawing code) means old cached images won't be reused
+RENDER_SETTINGS = {
+    "version": 3,
+    "graph_dpi": 600,
+    # "seaborn" or "pillow", pillow draws the same graph without matplotlib, which is quicker and makes smaller files
+    "chart_backend": "seaborn",
+    # The widths of the smaller copies of every image the report's srcset picks from, and what format they're saved in
+    # ("avif" works too if Pillow was built with AVIF support)
+    "variant_widths": [480, 960, 1600],
+    "variant_format": "webp",
+}
+
+
+# The playlist's cover art is kept in its folder exactly as spotify sent it, so a heading can be drawn again from the
+# render cache. Spotify's covers are JPEGs, but Pillow goes by a file's contents rather than its name either way.
+# Playlists saved before then have their cover as a PNG
+COVER_FILE = "playlist_image.jpg"
+LEGACY_COVER_FILE = "playlist_image.png"
 
-        prop = FontProperties(fname=path)
+# Once a playlist's graph and heading are drawn, a fingerprint of the RENDER_SETTINGS they were drawn with is saved next
+# to them, so rerender.py can tell which playlists need drawing again after the settings change
+RENDER_STAMP_FILE = "render_stamp"
 
-        sb.set(style="darkgrid", font=prop.get_name())
 
-        self.spot_green = "#1DB954"
-    def generate_final_image(self):
-        # Essentially, instead of trying to format the python_spotify_end.html file, I have decided to just list a
-        # series of images in the HTML file and format those images using pillow, so this is going to be a large image
-        # That has the playlist art cover, and also the info about it, it's name and number. It does admitedly look
-        # A bit unprofessional on the HTML page because you can save this image, but it makes the HTML and CSS coding
-        # Much easier, essentially it's moving the work that would be done there into python
+def render_variants():
+    return RENDER_SETTINGS["variant_widths"], RENDER_SETTINGS["variant_format"]
 
-        playlist_image = Image.open(
-            f"static/spotify_instances/{self.instance_id}/playlist{self.playlist_num}/playlist_image.png")
 
-        # This is the padding around the playlist art where we'll add text
-        # The values are a bit add hoc, they were just eyeballed with trial and error
+def render_fingerprint():
+    settings = json.dumps(RENDER_SETTINGS, sort_keys=True)
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
 
-        right = 5000
-        left = 300
-        top = 1400
-        bottom = 400
 
-        # We get the dimensions of the playlist icon
-        width, height = playlist_image.size
+def render_up_to_date(folder):
+    # Whether the playlist's images were drawn with the RENDER_SETTINGS we have now
+    if not (os.path.exists(f"{folder}/graph.jpg") and os.path.exists(f"{folder}/final_heading.jpg")):
+        return False
 
-        # We add that to the padding
-        new_width = width + right + left
-        new_height = height + top + bottom
+    try:
+        with open(f"{folder}/{RENDER_STAMP_FILE}", "r") as f:
+            return f.read().strip() == render_fingerprint()
+    except OSError:
+        return False
 
-        # We create an image with those dimensions
-        result = Image.new(playlist_image.mode, (new_width, new_height), (255, 255, 255))
 
-        # We paste the playlist image into that image
-        result.paste(playlist_image, (left, top))
+def release_years(dates):
+    # Whatever the precision of a release date ("yyyy", "yyyy-mm" or "yyyy-mm-dd") its first four characters are the
+    # year, so rather than parsing every date we make one numpy array of four character strings and convert them all
+    # at once. We get back one uint16 year per date, with 0 for anything that isn't a four digit year (missing dates
+    # come through as None, and Spotify itself uses "0000" when it doesn't know the year)
+    import numpy as np
 
-        # We call draw the new image which will have the
-        draw = ImageDraw.Draw(result)
+    four_chars = np.array(dates, dtype="U4")
+    valid = np.char.isdigit(four_chars) & (np.char.str_len(four_chars) == 4)
 
-        # Adding three bits of text: a playlist number text, a title text and a description text
-        draw.text((left, 1100), f"PLAYLIST {self.playlist_num + 1}", fill=(100, 100, 100), font=big_font)
-        draw.text((left + width + 150, top + 100), self.playlist_name, fill=(0, 0, 0), font=medium_font)
-        draw.text((left + width + 150, top + 300), self.playlist_description, fill=(0, 0, 0), font=small_font)
+    years = np.zeros(len(four_chars), dtype=np.uint16)
+    years[valid] = four_chars[valid].astype(np.uint16)
+    return years
 
 
+def years_from_release_dates(dates):
+    # The years of the dates we could read, counting unknown years would stretch the graph back to year 0
+    years = release_years(dates)
+    return years[years > 0]
 
-        # Saving this new image as 'final heading'
-        result.save(f"static/spotify_instances/{self.instance_id}/playlist{self.playlist_num}/final_heading.jpg")
 
-    def year_graph_from_data(self, date_list):
-        # Using our list to create a jpg bar chart
-
-        # FORMATTING THE DATA
-
-        # Turning the list of strings into a pandas series of floats
-        date_series = pd.Series(date_list).astype(float)
-
-        # Cutting off the last digit of the year to group the decades
-        decades_series = (date_series / 10).astype(int)
+class DecadeHistogram:
+    # A running count of how many tracks are in each decade. The SpotifyGrabber feeds it one page of tracks at a time
+    # so a playlist never has to be held in memory all at once. Decades are keyed by their first year, so 1987 -> 1980
 
-        # Counting the entries in each decade and sorting them
-        decades_count = decades_series.value_counts().sort_index()
+    def __init__(self, counts=None):
+        # Counts loaded back from a saved playlist have string keys so we turn them back into numbers
+        self.counts = Counter({int(decade): count for decade, count in (counts or {}).items()})
 
-        # Filling in the missing decades
-        decades_count = decades_count.reindex(range(decades_count.index.min(), decades_count.index.max() + 1))
+    def add_years(self, years):
+        # The years can be numbers or release date strings, either way the decades are worked out with whole array
+        # integer division and counted with numpy rather than one at a time
+        # numpy is imported here so importing this file (which the web app does) stays quick
+        import numpy as np
 
-        # Giving those decades a count of 0
-        decades_count = decades_count.fillna(0)
+        years = np.asarray(years)
 
-        # Making the decades index more presentable
-        decades_count.index = decades_count.index.astype("string") + "0s"
+        if years.dtype.kind in "USO":
+            years = years_from_release_dates(years)
+        else:
+            years = years[years > 0]
 
-        # GRAPHING THE DATA
+        decades, counts = np.unique(years.astype(np.int64) // 10 * 10, return_counts=True)
+        self.counts.update(dict(zip(decades.tolist(), counts.tolist())))
 
-        figure = sb.barplot(x=decades_count.index, y=decades_count, color=self.spot_green)
+    def add_tracks(self, items):
+        # Pulling out the release dates, things like local files have no album so they get skipped
+        dates = []
+        undated = []
+        for item in items:
+            try:
+                dates.append(item["track"]["album"]["release_date"])
+            except (KeyError, TypeError):
+                undated.append(item)
 
-        figure.set(xlabel="Decades", ylabel="Tracks",
-                   title=f"What decades are the tracks in {self.playlist_name} from?",
-                   yticks=(range(int(decades_count.min()), int(decades_count.max() + 1),
-                                 int(decades_count.max() / 10 + 1))))
+        # Tracks that came with only their album's id get its release date from the album index
+        if undated:
+            get_album_index().fill_release_dates(undated)
+            for item in undated:
+                try:
+                    dates.append(item["track"]["album"]["release_date"])
+                except (KeyError, TypeError):
+                    pass
 
-        figure.set_xticklabels(figure.get_xticklabels(), rotation=30)
+        self.add_years(dates)
 
-        plt.savefig(f"static/spotify_instances/{self.instance_id}/playlist{self.playlist_num}/graph.jpg", dpi=600)
+    def to_dict(self):
+        # JSON needs string keys
+        return {str(decade): count for decade, count in sorted(self.counts.items())}
 
-        plt.close()
 
-    def create_year_graph(self):
-
-        # We first need to get a list of the years of all of the tracks from the playlists json file
-
-        date_list = []
+class PlaylistAnalyser:
+    def __init__(self, instance_id, playlist_num):
+        # Adds the user and the playlist as attributes
+        self.instance_id = instance_id
+        self.playlist_num = playlist_num
 
-        for track in self.playlist_data["tracks"]["items"]:
+        self.folder = f"static/spotify_instances/{self.instance_id}/playlist{self.playlist_num}"
 
-            # Different tracks give different levels of precision for the release date. It can be the day, month or year
-            # We want to fill our list with years in the form "yyyy"
+        # Getting the playlist data as an attribute, playlists are saved as a snapshot.bin (older instances have a
+        # data.json instead) and load_playlist_details reads whichever one this playlist has
+        # snapshot_store uses the DecadeHistogram from this file, so it's imported here rather than at the top
+        from snapshot_store import load_playlist_details
+        self.playlist_data = load_playlist_details(self.folder)
 
-            precision = track["track"]["album"]["release_date_precision"]
-            date = track["track"]["album"]["release_date"]
+        # Setting the playlists name as an attribute
+        self.playlist_name = self.playlist_data["name"]
+        self.playlist_description = self.playlist_data["description"]
+        self.link = self.playlist_data["link"]
+
+    def record_render(self, stage, timings):
+        # The render engine tells us how long its worker spent drawing, encoding and making the smaller copies
+        for step, seconds in timings.items():
+            record_stage(f"{stage}_{step}", seconds, playlist=self.playlist_num)
+
+    def read_cover(self):
+        # The cover art's bytes from the playlist's folder
+        cover_path = f"{self.folder}/{COVER_FILE}"
+        if not os.path.exists(cover_path):
+            cover_path = f"{self.folder}/{LEGACY_COVER_FILE}"
+
+        with open(cover_path, "rb") as f:
+            return f.read()
+
+    def generate_final_image(self, cover_data=None):
+        # The heading image with the playlist's cover art, number, name and description, drawn by the render engine
+        # The grabber hands over the cover it just downloaded, otherwise (drawing a heading again for a playlist from
+        # the render cache) it's read from the folder
+        # heading_render is the whole wait, including for a free worker
+        if cover_data is None:
+            cover_data = self.read_cover()
+
+        with timed("heading_render", playlist=self.playlist_num):
+            timings = get_render_engine().final_image(f"{self.folder}/final_heading.jpg", cover_data,
+                                                      self.playlist_num, self.playlist_name, self.playlist_description,
+                                                      render_variants())
+        self.record_render("heading", timings)
 
-            if precision == "day":
-                strp_date = datetime.strptime(date, "%Y-%m-%d")
-                year = strp_date.year
+    def year_graph_from_data(self, date_list):
+        # Using our list of years to create a jpg bar chart
+        histogram = DecadeHistogram()
+        histogram.add_years(date_list)
 
-            elif precision == "month":
-                strp_date = datetime.strptime(date, "%Y-%m")
-                year = strp_date.year
+        self.year_graph_from_counts(histogram.counts)
 
-            elif precision == "year":
-                year = date
+    def year_graph_from_counts(self, decade_counts):
+        # Using the number of tracks in each decade to create a jpg bar chart, drawn by the render engine
+        with timed("graph_render", playlist=self.playlist_num):
+            timings = get_render_engine().year_graph(f"{self.folder}/graph.jpg", decade_counts, self.playlist_name,
+                                                     RENDER_SETTINGS["graph_dpi"], RENDER_SETTINGS["chart_backend"],
+                                                     render_variants())
+        self.record_render("graph", timings)
 
-            else:
-                print(f"ALERT: THERE IS A {date}")
+    def create_year_graph(self, cover_data=None):
 
-            date_list.append(year)
+        # The decade counts were worked out when the playlist was saved (or when an old data.json was loaded)
+        histogram = DecadeHistogram(self.playlist_data["decade_counts"])
 
         # Here we have a separate function which produces and saves the actual graph
         try:
-            self.year_graph_from_data(date_list)
-            self.generate_final_image()
+            self.year_graph_from_counts(histogram.counts)
+            self.generate_final_image(cover_data)
         except:
             # Sometimes there can be access errors on spotify's end. If this happens then the playlists which encountered
             # issues won't have their associated images, but we'll still hopefully get some results
-            pass
+            return False
+
+        with open(f"{self.folder}/{RENDER_STAMP_FILE}", "w") as f:
+            f.write(render_fingerprint())
+        return True
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# The render cache keeps the files we made for a playlist so that the next time anyone asks for that playlist, and it
+# hasn't changed, we can copy them instead of fetching and drawing everything again. Spotify gives every version of a
+# playlist a new snapshot_id, so an entry is keyed on the playlist id, its snapshot_id and the settings we render with
+
+RENDER_CACHE_DIR = "storage/render_cache"
+
+# Once the cache is bigger than this the entries that were used least recently are deleted
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# The heading has the playlist's position in the report drawn on it, so its files (the jpg and its smaller copies) are
+# kept separately for every position the playlist has been shown at. Every other file in the folder is shared
+HEADING_PREFIX = "final_heading"
+
+
+def is_heading_file(name):
+    return name.startswith(HEADING_PREFIX)
+
+
+def heading_directory(playlist_num):
+    return f"heading_{playlist_num}"
+
+
+def copy_files(source, destination, names):
+    for name in names:
+        shutil.copyfile(os.path.join(source, name), os.path.join(destination, name))
+
+
+def file_names(path):
+    return [entry.name for entry in os.scandir(path) if entry.is_file(follow_symlinks=False)]
+
+
+def cache_key(playlist_id, snapshot_id, render_settings):
+    key_data = json.dumps([playlist_id, snapshot_id, render_settings], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def directory_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += directory_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+class RenderCache:
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # We keep a running total of the cache size so we only have to look through it when it needs trimming
+        self.lock = threading.Lock()
+        self.total_bytes = sum(directory_size(entry.path) for entry in os.scandir(self.directory) if entry.is_dir())
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def restore(self, key, destination):
+        # Copies a cached playlist's data, image and graph into its folder in a report
+        # Returns False if there's nothing cached. Entries are renamed into place once they're complete, so if the
+        # folder is there everything in it is too
+        entry = self.entry_path(key)
+
+        try:
+            os.makedirs(destination, exist_ok=True)
+            copy_files(entry, destination, file_names(entry))
+
+            # Touching the entry marks it as recently used
+            os.utime(entry)
+        except OSError:
+            # Either it was never cached or it was evicted while we were copying it
+            return False
+
+        return True
+
+    def restore_heading(self, key, destination, playlist_num):
+        # Copies the final heading for this playlist number if we've drawn one before
+        headings = os.path.join(self.entry_path(key), heading_directory(playlist_num))
+
+        try:
+            copy_files(headings, destination, file_names(headings))
+        except OSError:
+            return False
+
+        return True
+
+    def store(self, key, source, playlist_num):
+        # Saves a finished playlist folder into the cache
+        entry = self.entry_path(key)
+        added_bytes = 0
+
+        try:
+            names = file_names(source)
+
+            # Each part is put together in a temporary folder and renamed into place, so nobody can restore it half
+            # written. If another thread beat us to it the rename fails and we just throw ours away
+            if not os.path.isdir(entry):
+                temp_entry = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+                copy_files(source, temp_entry, [name for name in names if not is_heading_file(name)])
+                try:
+                    os.rename(temp_entry, entry)
+                    added_bytes += directory_size(entry)
+                except OSError:
+                    shutil.rmtree(temp_entry, ignore_errors=True)
+
+            headings = os.path.join(entry, heading_directory(playlist_num))
+            if not os.path.isdir(headings):
+                temp_headings = tempfile.mkdtemp(dir=entry, prefix=".tmp-")
+                copy_files(source, temp_headings, [name for name in names if is_heading_file(name)])
+                try:
+                    os.rename(temp_headings, headings)
+                    added_bytes += directory_size(headings)
+                except OSError:
+                    shutil.rmtree(temp_headings, ignore_errors=True)
+
+        except OSError:
+            print(f"Render Cache Store Error, key: {key}")
+
+        with self.lock:
+            self.total_bytes += added_bytes
+            over_budget = self.total_bytes > self.max_bytes
+
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        # Deletes the least recently used entries until the cache is back under its size limit
+        # Left over temporary folders older than an hour are cleaned up too
+        with self.lock:
+            entries = []
+            total_bytes = 0
+            for entry in os.scandir(self.directory):
+                if not entry.is_dir():
+                    continue
+
+                try:
+                    last_used = entry.stat().st_mtime
+                    if entry.name.startswith(".tmp-"):
+                        if time.time() - last_used > 3600:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                        continue
+                    size = directory_size(entry.path)
+                except OSError:
+                    continue
+
+                entries.append((last_used, size, entry.path))
+                total_bytes += size
+
+            entries.sort()
+            for last_used, size, path in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total_bytes -= size
+
+            self.total_bytes = total_bytes
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    # The one RenderCache for this process, every SpotifyGrabber shares it
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = RenderCache()
+
+    return _cache
@@ -0,0 +1,443 @@
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# Drawing the graphs and headings is the slowest CPU work in a report, and matplotlib isn't safe to use from more
+# than one thread at a time. So the drawing is done by a pool of worker processes instead. Every worker sets up its
+# RenderContext (fonts and seaborn style) once, and draws onto its own Figure objects rather than through pyplot,
+# so nothing is shared between drawings and as many can be made at once as there are processes
+
+# How many worker processes draw at once. Setting this to 0 draws in the calling process instead, one at a time
+RENDER_PROCESSES = os.cpu_count() or 1
+
+# How long a worker can spend on one drawing before we give up on it and start a new worker in its place, in seconds
+RENDER_TIMEOUT = 120
+
+# The most memory (address space) each worker process may use, in bytes, so a drawing that would take more fails with a
+# MemoryError rather than running the machine short. A 600 dpi seaborn graph peaks at around a third of this.
+# None leaves the workers unlimited
+RENDER_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+SPOT_GREEN = "#1DB954"
+
+# seaborn mutes bar colours a little, this is SPOT_GREEN after that
+SEABORN_GREEN = "#31A55A"
+
+# Only used when RENDER_PROCESSES is 0, the seaborn style and font cache are still global to the process
+RENDER_LOCK = threading.Lock()
+
+# Cover art is never drawn bigger than this (spotify's own covers are 640 wide), bigger covers are shrunk as they're
+# decoded. Covers with more pixels than MAX_COVER_PIXELS aren't decoded at all
+COVER_SIZE = 640
+MAX_COVER_PIXELS = 16 * 1024 * 1024
+
+
+class RenderContext:
+    # Everything a process needs for drawing: the fonts, the plotting modules and the seaborn style. Each piece is
+    # set up the first time it's needed and then kept for as long as the process runs, so it's paid for once per
+    # process rather than once per playlist. The plotting modules are imported here rather than at the top of the
+    # file, so the web process, which never draws, doesn't have to load them, and neither does a process that only
+    # uses the pillow graph
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fonts = {}
+        self.plotting = None
+
+    def font(self, name, size):
+        # A Pillow font from the fonts folder, each name and size is only loaded once
+        key = (name, size)
+        if key not in self.fonts:
+            from PIL import ImageFont
+            with self.lock:
+                self.fonts.setdefault(key, ImageFont.truetype(f"fonts/{name}.ttf", size, encoding="unic"))
+        return self.fonts[key]
+
+    def get_plotting(self):
+        # matplotlib, seaborn and pandas, with our font registered and the seaborn style applied
+        with self.lock:
+            if self.plotting is None:
+                import matplotlib
+                matplotlib.use("Agg")
+
+                import pandas as pd
+                import seaborn as sb
+                from matplotlib.figure import Figure
+                from matplotlib.backends.backend_agg import FigureCanvasAgg
+                from matplotlib.font_manager import fontManager, FontProperties
+
+                # Adding a spotify-esque font and setting seaborn style for the inevitable graphs
+                path = "fonts/GothamMedium.ttf"
+                fontManager.addfont(path)
+                prop = FontProperties(fname=path)
+                sb.set(style="darkgrid", font=prop.get_name())
+
+                self.plotting = {"pd": pd, "sb": sb, "Figure": Figure, "FigureCanvasAgg": FigureCanvasAgg}
+
+        return self.plotting
+
+    def warm_up(self):
+        # Loads everything the default drawings need, so the first report a worker draws isn't slower than the rest
+        self.get_plotting()
+        for name, size in HEADING_FONTS.values():
+            self.font(name, size)
+
+
+# The fonts drawn on the final heading
+HEADING_FONTS = {
+    "number": ("GothamBold", 100),
+    "name": ("GothamMedium", 150),
+    "description": ("GothamMedium", 100),
+}
+
+# Each process has one render context, it costs nothing until something is drawn
+render_context = RenderContext()
+
+
+def limit_memory(limit):
+    # Only unix has resource, elsewhere the workers aren't limited
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def warm_up():
+    # The pool's initializer, so every worker has its memory limit set and has loaded everything before it's given
+    # anything to draw
+    if RENDER_MEMORY_LIMIT is not None:
+        limit_memory(RENDER_MEMORY_LIMIT)
+    render_context.warm_up()
+
+
+def draw_year_graph(decade_counts, playlist_name, dpi):
+    # Using the number of tracks in each decade to create a bar chart
+    plotting = render_context.get_plotting()
+    pd = plotting["pd"]
+    sb = plotting["sb"]
+
+    # FORMATTING THE DATA
+
+    # Turning the counts into a pandas series sorted by decade
+    decades_count = pd.Series(decade_counts, dtype=int).sort_index()
+
+    # Filling in the missing decades
+    decades_count = decades_count.reindex(range(decades_count.index.min(), decades_count.index.max() + 10, 10))
+
+    # Giving those decades a count of 0
+    decades_count = decades_count.fillna(0)
+
+    # Making the decades index more presentable
+    decades_count.index = decades_count.index.astype("string") + "s"
+
+    # GRAPHING THE DATA
+
+    # A Figure of our own rather than pyplot's global one, it's thrown away once it's drawn
+    figure = plotting["Figure"](dpi=dpi)
+    canvas = plotting["FigureCanvasAgg"](figure)
+    axes = figure.subplots()
+
+    sb.barplot(x=decades_count.index, y=decades_count, color=SPOT_GREEN, ax=axes)
+
+    axes.set(xlabel="Decades", ylabel="Tracks",
+             title=f"What decades are the tracks in {playlist_name} from?",
+             yticks=(range(int(decades_count.min()), int(decades_count.max() + 1),
+                           int(decades_count.max() / 10 + 1))))
+
+    axes.set_xticks(axes.get_xticks())
+    axes.set_xticklabels(axes.get_xticklabels(), rotation=30)
+
+    # Drawing the figure and handing its pixels over to Pillow, which saves it along with the smaller versions
+    from PIL import Image
+
+    canvas.draw()
+    return Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba()).convert("RGB")
+
+
+def decade_bars(decade_counts):
+    # The decades from the first to the last with their counts, including the empty ones in between, as
+    # ("1980s", count) pairs
+    first = min(decade_counts)
+    last = max(decade_counts)
+    return [(f"{decade}s", decade_counts.get(decade, 0)) for decade in range(first, last + 10, 10)]
+
+
+def draw_year_graph_pillow(decade_counts, playlist_name, dpi):
+    # The same bar chart as draw_year_graph but drawn straight onto a Pillow image, which skips matplotlib entirely.
+    # The sizes, margins and colours copy what matplotlib and seaborn's darkgrid style give us, so the two look alike
+    from PIL import Image, ImageDraw
+
+    bars = decade_bars(decade_counts)
+    lowest = min(count for decade, count in bars)
+    highest = max(count for decade, count in bars)
+
+    # matplotlib's default figure is 6.4 by 4.8 inches, and its font sizes are in points (1/72 of an inch)
+    width, height = int(6.4 * dpi), int(4.8 * dpi)
+    point = dpi / 72
+
+    text_colour = (38, 38, 38)
+    title_font = render_context.font("GothamMedium", round(12 * point))
+    label_font = render_context.font("GothamMedium", round(12 * point))
+    tick_font = render_context.font("GothamMedium", round(11 * point))
+
+    image = Image.new("RGB", (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+
+    # The grey plotting area, using matplotlib's default subplot margins
+    left, right = int(0.125 * width), int(0.9 * width)
+    top, bottom = int(0.12 * height), int(0.89 * height)
+    draw.rectangle((left, top, right, bottom), fill=(234, 234, 242))
+
+    # matplotlib leaves 5% of headroom above the tallest bar
+    y_max = max(highest * 1.05, 1)
+
+    def y_position(count):
+        return bottom - (bottom - top) * count / y_max
+
+    # White grid lines and labels at the same ticks as the seaborn graph
+    line_width = max(1, round(point))
+    for tick in range(lowest, highest + 1, int(highest / 10 + 1)):
+        y = y_position(tick)
+        draw.line((left, y, right, y), fill=(255, 255, 255), width=line_width)
+        draw.text((left - 6 * point, y), str(tick), fill=text_colour, font=tick_font, anchor="rm")
+
+    # The bars take up 80% of their slot like seaborn's do, and use the slightly muted green seaborn draws
+    slot = (right - left) / len(bars)
+    for i, (decade, count) in enumerate(bars):
+        centre = left + slot * (i + 0.5)
+        if count:
+            draw.rectangle((centre - 0.4 * slot, y_position(count), centre + 0.4 * slot, bottom),
+                           fill=SEABORN_GREEN, outline=(255, 255, 255), width=line_width)
+
+        # Tick labels are turned 30 degrees, so they're drawn on their own image and rotated before pasting
+        text_box = draw.textbbox((0, 0), decade, font=tick_font)
+        label = Image.new("L", (text_box[2], text_box[3]), 0)
+        ImageDraw.Draw(label).text((0, 0), decade, fill=255, font=tick_font)
+        label = label.rotate(30, expand=True, resample=Image.BICUBIC)
+        image.paste(text_colour, (int(centre - label.width / 2), int(bottom + 4 * point)), label)
+
+    # The title above the plot and the y axis label. The seaborn graph's "Decades" label ends up below the bottom of
+    # the image, so we leave it off here too
+    draw.text(((left + right) / 2, top - 6 * point), f"What decades are the tracks in {playlist_name} from?",
+              fill=text_colour, font=title_font, anchor="md")
+
+    text_box = draw.textbbox((0, 0), "Tracks", font=label_font)
+    label = Image.new("L", (text_box[2], text_box[3]), 0)
+    ImageDraw.Draw(label).text((0, 0), "Tracks", fill=255, font=label_font)
+    label = label.rotate(90, expand=True)
+    image.paste(text_colour, (int(left - 40 * point), int((top + bottom - label.height) / 2)), label)
+
+    return image
+
+
+# The ways we can draw the decade graph, RENDER_SETTINGS["chart_backend"] picks one
+CHART_BACKENDS = {
+    "seaborn": draw_year_graph,
+    "pillow": draw_year_graph_pillow,
+}
+
+
+def load_cover(cover_data):
+    # Decodes the cover art straight from the bytes spotify sent, to at most COVER_SIZE square
+    from PIL import Image
+
+    cover = Image.open(io.BytesIO(cover_data))
+
+    # Opening only reads the header, so we can turn down enormous images before decoding a single pixel
+    if cover.width * cover.height > MAX_COVER_PIXELS:
+        raise ValueError(f"Cover art is too big to draw: {cover.width}x{cover.height}")
+
+    # For JPEGs draft has the decoder itself scale down by a half, a quarter or an eighth, so a big cover is never
+    # decoded at full size. thumbnail then takes it the rest of the way, and leaves covers that already fit alone
+    cover.draft("RGB", (COVER_SIZE, COVER_SIZE))
+    cover = cover.convert("RGB")
+    cover.thumbnail((COVER_SIZE, COVER_SIZE), Image.LANCZOS)
+
+    return cover
+
+
+def draw_final_image(cover_data, playlist_num, playlist_name, playlist_description):
+    # Essentially, instead of trying to format the python_spotify_end.html file, I have decided to just list a
+    # series of images in the HTML file and format those images using pillow, so this is going to be a large image
+    # That has the playlist art cover, and also the info about it, it's name and number. It does admitedly look
+    # A bit unprofessional on the HTML page because you can save this image, but it makes the HTML and CSS coding
+    # Much easier, essentially it's moving the work that would be done there into python
+    from PIL import Image, ImageDraw
+
+    # The cover comes as the image file's bytes, either just downloaded or read back from the playlist's folder
+    playlist_image = load_cover(cover_data)
+
+    # This is the padding around the playlist art where we'll add text
+    # The values are a bit add hoc, they were just eyeballed with trial and error
+
+    right = 5000
+    left = 300
+    top = 1400
+    bottom = 400
+
+    # We get the dimensions of the playlist icon
+    width, height = playlist_image.size
+
+    # We add that to the padding
+    new_width = width + right + left
+    new_height = height + top + bottom
+
+    # We create an image with those dimensions
+    result = Image.new("RGB", (new_width, new_height), (255, 255, 255))
+
+    # We paste the playlist image into that image
+    result.paste(playlist_image, (left, top))
+
+    # We call draw the new image which will have the
+    draw = ImageDraw.Draw(result)
+
+    # Adding three bits of text: a playlist number text, a title text and a description text
+    draw.text((left, 1100), f"PLAYLIST {playlist_num + 1}", fill=(100, 100, 100),
+              font=render_context.font(*HEADING_FONTS["number"]))
+    draw.text((left + width + 150, top + 100), playlist_name, fill=(0, 0, 0),
+              font=render_context.font(*HEADING_FONTS["name"]))
+    draw.text((left + width + 150, top + 300), playlist_description, fill=(0, 0, 0),
+              font=render_context.font(*HEADING_FONTS["description"]))
+
+    return result
+
+
+def save_variants(image, path, variants):
+    # Saving smaller copies of an image for the report's srcset, so phones and small windows don't have to download
+    # the full size one. variants is (widths, format), and a 960 wide webp of graph.jpg is saved as graph_960.webp
+    # Each copy is shrunk from the one before it, largest first, which is a lot quicker than always shrinking the
+    # full size image
+    from PIL import Image
+
+    widths, image_format = variants
+    stem = os.path.splitext(path)[0]
+
+    # reducing_gap lets Pillow halve the image with a quick box filter before the slower, sharper Lanczos resize, and a
+    # lower encoder method keeps the webp encoding cheap, most of the size saving comes from the smaller dimensions
+    for width in sorted(widths, reverse=True):
+        if width < image.width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS,
+                                 reducing_gap=1.0)
+        image.save(f"{stem}_{width}.{image_format}", quality=80, method=2)
+
+
+def render_to_files(path, variants, draw, *args):
+    # Runs one of the draw functions and saves what it drew, plus the smaller copies if variants are given
+    # This runs in the worker processes, so the encoding is spread across them along with the drawing
+    # It gives back how long the drawing, the encoding and the smaller copies took, for the metrics
+    start_time = time.perf_counter()
+    image = draw(*args)
+    timings = {"draw": time.perf_counter() - start_time}
+
+    # Same JPEG quality matplotlib saves with, optimising the encoding takes a little longer but the file is about a
+    # third smaller
+    start_time = time.perf_counter()
+    image.convert("RGB").save(path, quality=75, optimize=True)
+    timings["encode"] = time.perf_counter() - start_time
+
+    if variants:
+        start_time = time.perf_counter()
+        save_variants(image, path, variants)
+        timings["variants"] = time.perf_counter() - start_time
+
+    return timings
+
+
+class RenderWorker:
+    # One worker process, in a pool of its own. A ProcessPoolExecutor fails everything it's running once any of its
+    # processes dies, so giving each worker its own means one that has to be stopped doesn't take the drawings the
+    # other workers are making with it
+
+    def __init__(self):
+        # Workers are started with spawn rather than fork, forking a web server that's running threads can leave
+        # the child holding locks that nobody will ever release
+        self.pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=warm_up)
+
+        # A spawn pool starts its process with the first thing it's given, so it's already warming up by the time
+        # the first report needs something drawn
+        self.ready = self.pool.submit(os.getpid)
+
+    def run(self, function, *args):
+        # Warming up isn't part of the drawing, so RENDER_TIMEOUT only starts once it's done
+        self.ready.result(timeout=RENDER_TIMEOUT)
+        return self.pool.submit(function, *args).result(timeout=RENDER_TIMEOUT)
+
+    def stop(self):
+        # A process that's stuck drawing wouldn't stop when its pool shuts down, so it's stopped here. There's no
+        # public way to get at a ProcessPoolExecutor's processes before python 3.14's terminate_workers()
+        for process in list((self.pool._processes or {}).values()):
+            process.terminate()
+
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class RenderEngine:
+    def __init__(self, processes=RENDER_PROCESSES):
+        self.processes = processes
+        self.workers = None
+
+        # The workers that aren't drawing anything, a drawing waits here for one to be free
+        if processes > 0:
+            self.workers = queue.Queue()
+            for _ in range(processes):
+                self.workers.put(RenderWorker())
+
+    def run(self, function, *args):
+        # Runs one of the draw functions, in a worker process if there are any, and waits for it to finish
+        # Anything that goes wrong in the worker is raised here
+        if self.workers is None:
+            with RENDER_LOCK:
+                return function(*args)
+
+        # The drawing is only handed to a worker that's free, so time spent waiting for one never counts towards
+        # RENDER_TIMEOUT, only the drawing itself does
+        worker = self.workers.get()
+        try:
+            return worker.run(function, *args)
+        except (BrokenProcessPool, FutureTimeoutError):
+            # The worker died (most likely killed for using too much memory) or is stuck, so it's swapped for a new
+            # one. The other workers carry on with what they're drawing
+            print("Render Worker Restarted")
+            worker.stop()
+            worker = RenderWorker()
+            raise
+        finally:
+            self.workers.put(worker)
+
+    def year_graph(self, path, decade_counts, playlist_name, dpi, backend="seaborn", variants=None):
+        return self.run(render_to_files, path, variants, CHART_BACKENDS[backend], dict(decade_counts), playlist_name,
+                        dpi)
+
+    def final_image(self, path, cover_data, playlist_num, playlist_name, playlist_description, variants=None):
+        return self.run(render_to_files, path, variants, draw_final_image, cover_data, playlist_num, playlist_name,
+                        playlist_description)
+
+    def shutdown(self):
+        while self.workers is not None and not self.workers.empty():
+            self.workers.get().pool.shutdown()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_render_engine():
+    # The one RenderEngine for this process, its workers are started the first time something needs drawing
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = RenderEngine()
+
+    return _engine
@@ -0,0 +1,73 @@
+import os
+from functools import lru_cache
+
+import json_codec
+from playlist_analyser import render_variants
+from snapshot_store import load_playlist_details
+
+# A report manifest is a small file written once when a report is finished. It has everything the /report/ page needs
+# (the playlists in order, their names, links, images and decade counts), so showing a report doesn't have to look
+# through the instance's folders or open every playlist's snapshot
+
+# How many reports' manifests we keep in memory
+REPORT_CACHE_SIZE = 256
+
+
+def manifest_path(instance_id):
+    return f"static/spotify_instances/{instance_id}/data/report_manifest.json"
+
+
+def playlist_entry(instance_id, playlist_number, widths, image_format):
+    # Everything the report page needs for one playlist, or None if it didn't make it to having its images
+    path = f"{instance_id}/playlist{playlist_number}"
+    folder = f"static/spotify_instances/{path}"
+
+    if not (os.path.exists(f"{folder}/graph.jpg") and os.path.exists(f"{folder}/final_heading.jpg")):
+        return None
+
+    playlist_data = load_playlist_details(folder)
+
+    return {
+        "path": path,
+        "number": playlist_number,
+        "name": playlist_data["name"],
+        "link": playlist_data["link"],
+        "heading": "final_heading.jpg",
+        "graph": "graph.jpg",
+        "variants": os.path.exists(f"{folder}/graph_{widths[0]}.{image_format}"),
+        "decade_counts": playlist_data["decade_counts"],
+    }
+
+
+def write_report_manifest(instance_id, playlist_list):
+    # Writes the manifest for every playlist in playlist_list that made it all the way to having its images
+    widths, image_format = render_variants()
+
+    playlists = []
+    for playlist in sorted(playlist_list, key=lambda playlist: playlist["playlist_number"]):
+        entry = playlist_entry(instance_id, playlist["playlist_number"], widths, image_format)
+        if entry is not None:
+            playlists.append(entry)
+
+    manifest = {
+        "instance_id": instance_id,
+        "variant_widths": widths,
+        "variant_format": image_format,
+        "playlists": playlists,
+    }
+
+    # Writing to a temporary file and renaming it, so the report page never reads a half written manifest
+    temp_path = manifest_path(instance_id) + ".tmp"
+    json_codec.dump(manifest, temp_path)
+    os.replace(temp_path, manifest_path(instance_id))
+
+    return manifest
+
+
+@lru_cache(maxsize=REPORT_CACHE_SIZE)
+def load_report_manifest(instance_id):
+    # Reads a report's manifest, the most recently used ones are kept in memory
+    # If the report doesn't have a manifest yet this raises FileNotFoundError, and lru_cache doesn't remember that, so
+    # we will look again next time. A manifest is only written once its report is finished, so what we keep in memory
+    # never goes out of date
+    return json_codec.load(manifest_path(instance_id))
@@ -0,0 +1,155 @@
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instance_registry
+import job_queue
+from metrics import metrics
+from playlist_analyser import PlaylistAnalyser, COVER_FILE, LEGACY_COVER_FILE, render_up_to_date, render_variants
+from render_engine import get_render_engine
+from report_manifest import manifest_path, write_report_manifest
+from snapshot_store import SNAPSHOT_FILE
+
+# Draws the graphs and headings of reports that have already been made again, from what's saved in their folders (the
+# snapshot.bin or data.json, and the cover art), without asking spotify for anything. Run it from the app's folder
+# after changing RENDER_SETTINGS or the drawing code:
+#   python rerender.py                  every playlist that wasn't drawn with the RENDER_SETTINGS we have now
+#   python rerender.py 12_AbCdEfGhIj    only these instances
+#   python rerender.py --force          every playlist, whatever it was drawn with
+#
+# The drawing is done by the render engine's worker processes, one per core. Each playlist is handed to the engine by
+# a thread of its own (a graph and then a heading), and there are twice as many threads as workers so a worker always
+# has its next drawing waiting. Reports that are being made right now are left alone
+
+# How often the progress line is printed, in seconds
+PROGRESS_INTERVAL = 2.0
+
+PLAYLIST_FOLDER = re.compile(r"playlist(\d+)$")
+
+
+def instance_playlists(instance_id):
+    # The numbers of the instance's playlists that have what we need to draw them
+    playlists = []
+
+    for entry in os.scandir(os.path.join(instance_registry.INSTANCES_PATH, instance_id)):
+        match = PLAYLIST_FOLDER.match(entry.name)
+        if not (match and entry.is_dir()):
+            continue
+
+        has_data = os.path.exists(f"{entry.path}/{SNAPSHOT_FILE}") or os.path.exists(f"{entry.path}/data.json")
+        has_cover = os.path.exists(f"{entry.path}/{COVER_FILE}") or os.path.exists(f"{entry.path}/{LEGACY_COVER_FILE}")
+        if has_data and has_cover:
+            playlists.append(int(match.group(1)))
+
+    return sorted(playlists)
+
+
+def find_instances(instance_ids=None):
+    # Every instance asked for (or every instance there is) apart from the ones with a report being made
+    if not instance_ids:
+        instance_ids = sorted(entry.name for entry in os.scandir(instance_registry.INSTANCES_PATH) if entry.is_dir())
+
+    busy = job_queue.busy_instances()
+    for instance_id in instance_ids:
+        if instance_id in busy:
+            print(f"Skipping {instance_id}, its report is being made")
+        elif not os.path.isdir(os.path.join(instance_registry.INSTANCES_PATH, instance_id)):
+            print(f"Skipping {instance_id}, there's no such instance")
+        else:
+            yield instance_id
+
+
+def remove_old_variants(folder):
+    # The smaller copies of the images that the RENDER_SETTINGS we have now won't make, so a change of widths or format
+    # doesn't leave the old ones behind
+    widths, image_format = render_variants()
+    wanted = {f"{stem}_{width}.{image_format}" for stem in ("graph", "final_heading") for width in widths}
+
+    for entry in os.scandir(folder):
+        if re.match(r"(graph|final_heading)_\d+\.\w+$", entry.name) and entry.name not in wanted:
+            os.remove(entry.path)
+
+
+def rerender_playlist(instance_id, playlist_number, force=False):
+    # Draws one playlist's graph and heading again, giving back "rendered", "up to date" or "failed"
+    folder = f"{instance_registry.INSTANCES_PATH}/{instance_id}/playlist{playlist_number}"
+    if not force and render_up_to_date(folder):
+        return "up to date"
+
+    try:
+        analyser = PlaylistAnalyser(instance_id=instance_id, playlist_num=playlist_number)
+        remove_old_variants(folder)
+    except (OSError, ValueError, KeyError, TypeError):
+        return "failed"
+
+    return "rendered" if analyser.create_year_graph() else "failed"
+
+
+def rerender_instances(instance_ids=None, force=False):
+    start_time = time.perf_counter()
+
+    playlists = []
+    for instance_id in find_instances(instance_ids):
+        playlists += [(instance_id, playlist_number) for playlist_number in instance_playlists(instance_id)]
+
+    engine = get_render_engine()
+    threads = max(engine.processes * 2, 1)
+    print(f"{len(playlists)} playlists to look at, drawing with {max(engine.processes, 1)} processes")
+
+    results = {"rendered": 0, "up to date": 0, "failed": 0}
+    rendered_instances = set()
+    last_progress = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {pool.submit(rerender_playlist, instance_id, playlist_number, force): (instance_id, playlist_number)
+                   for instance_id, playlist_number in playlists}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            instance_id, playlist_number = futures[future]
+            result = future.result()
+
+            results[result] += 1
+            if result == "rendered":
+                rendered_instances.add(instance_id)
+            elif result == "failed":
+                print(f"Rerender Error, instance: {instance_id}, playlist: {playlist_number}")
+
+            now = time.perf_counter()
+            if now - last_progress >= PROGRESS_INTERVAL or done == len(playlists):
+                last_progress = now
+                print(f"{done}/{len(playlists)} playlists, {results['rendered']} drawn, "
+                      f"{results['up to date']} up to date, {results['failed']} failed, "
+                      f"{results['rendered'] / (now - start_time):.1f} drawn/s")
+
+    # The reports' manifests say which smaller copies the images have, so the ones we drew again are written afresh.
+    # The web app keeps manifests in memory, but changing RENDER_SETTINGS means restarting it anyway
+    for instance_id in sorted(rendered_instances):
+        if os.path.exists(manifest_path(instance_id)):
+            write_report_manifest(instance_id, [{"playlist_number": playlist_number}
+                                                for playlist_number in instance_playlists(instance_id)])
+        instance_registry.update_size(instance_id, accessed=False)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{results['rendered']} playlists drawn in {len(rendered_instances)} instances in {elapsed:.1f}s "
+          f"({results['rendered'] / elapsed:.1f} playlists/s), {results['up to date']} already up to date, "
+          f"{results['failed']} failed")
+
+    stages = metrics.to_dict()["stages"]
+    for stage in ("graph_render", "heading_render"):
+        if stage in stages:
+            print(f"  {stage}: {stages[stage]['mean'] * 1000:.0f}ms mean, {stages[stage]['max'] * 1000:.0f}ms max")
+
+    engine.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draw the graphs and headings of saved reports again")
+    parser.add_argument("instance_ids", nargs="*", help="the instances to draw, every instance if none are given")
+    parser.add_argument("--force", action="store_true",
+                        help="draw every playlist again, even the ones drawn with the settings we have now")
+    args = parser.parse_args()
+
+    rerender_instances(args.instance_ids, force=args.force)
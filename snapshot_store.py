@@ -0,0 +1,215 @@
+import argparse
+import glob
+import os
+import struct
+import time
+from array import array
+
+import json_codec
+from album_index import get_album_index
+from playlist_analyser import DecadeHistogram, release_years
+
+# Instead of saving spotify's whole playlist as data.json, every playlist folder gets a snapshot.bin. It holds the
+# little we actually use: a JSON header with the playlist's name, description and link, and then one column of
+# release years (uint16) and one of release date precisions (uint8), one entry per track. That's 3 bytes a track
+# instead of the kilobyte or so spotify sends, and the columns load straight into numpy arrays with no parsing.
+#
+# The file is laid out as:
+#   b"PLSN", a format version byte, the header length (uint32), the JSON header,
+#   then the years, then the precisions, all little endian
+
+SNAPSHOT_FILE = "snapshot.bin"
+SNAPSHOT_MAGIC = b"PLSN"
+SNAPSHOT_VERSION = 1
+
+PREFIX = struct.Struct("<4sBI")
+
+# How we store release_date_precision, 0 is for tracks without a release date
+PRECISION_CODES = {"year": 1, "month": 2, "day": 3}
+
+
+class SnapshotWriter:
+    # Collects a playlist's tracks a page at a time as they come from spotify, keeping just the two columns, and keeps
+    # the decade counts up to date as it goes
+
+    def __init__(self):
+        self.years = array("H")
+        self.precisions = array("B")
+        self.histogram = DecadeHistogram()
+
+    def add_tracks(self, items):
+        dates = []
+        precisions = []
+        undated = []
+        for item in items:
+            try:
+                album = item["track"]["album"]
+                dates.append(album["release_date"])
+                precisions.append(PRECISION_CODES.get(album.get("release_date_precision"), 0))
+            except (KeyError, TypeError):
+                # Things like local files don't have an album, and tracks fetched with only their album's id are
+                # looked up in the album index below
+                undated.append(len(dates))
+                dates.append(None)
+                precisions.append(0)
+
+        if undated:
+            get_album_index().fill_release_dates([items[i] for i in undated])
+            for i in undated:
+                try:
+                    album = items[i]["track"]["album"]
+                    dates[i] = album["release_date"]
+                    precisions[i] = PRECISION_CODES.get(album.get("release_date_precision"), 0)
+                except (KeyError, TypeError):
+                    pass
+
+        years = release_years(dates)
+
+        self.years.frombytes(years.astype("<u2").tobytes())
+        self.precisions.extend(precisions)
+        self.histogram.add_years(years)
+
+    def write(self, path, playlist_data):
+        # playlist_data is what spotify told us about the playlist itself, minus its tracks
+        header = {
+            "id": playlist_data.get("id"),
+            "name": playlist_data["name"],
+            "description": playlist_data["description"],
+            "link": playlist_data["external_urls"]["spotify"],
+            "snapshot_id": playlist_data.get("snapshot_id"),
+            "total": playlist_data.get("tracks", {}).get("total"),
+            "track_count": len(self.years),
+            "decade_counts": self.histogram.to_dict(),
+        }
+        header_bytes = json_codec.dumps(header)
+
+        years = self.years
+        if struct.pack("=H", 1) != struct.pack("<H", 1):
+            # array uses the machine's byte order, the file is always little endian
+            years = array("H", years)
+            years.byteswap()
+
+        # Writing to a temporary file and renaming it so nobody ever reads half a snapshot
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            f.write(years.tobytes())
+            f.write(self.precisions.tobytes())
+        os.replace(temp_path, path)
+
+
+def check_prefix(data, path):
+    # Makes sure the file is a snapshot we know how to read, and gives back the length of its header
+    magic, version, header_length = PREFIX.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} playlist snapshot")
+    return header_length
+
+
+def read_snapshot_header(path):
+    # Just the header, for when we don't need the tracks
+    with open(path, "rb") as f:
+        header_length = check_prefix(f.read(PREFIX.size), path)
+        return json_codec.loads(f.read(header_length))
+
+
+class PlaylistSnapshot:
+    # A playlist loaded back from its snapshot.bin. The whole file is read in one go and the columns are numpy views
+    # onto it, so nothing is copied or parsed per track
+
+    def __init__(self, path):
+        import numpy as np
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        header_length = check_prefix(data, path)
+
+        start = PREFIX.size
+        self.header = json_codec.loads(data[start:start + header_length])
+
+        count = self.header["track_count"]
+        start += header_length
+        self.years = np.frombuffer(data, dtype="<u2", count=count, offset=start)
+        self.precisions = np.frombuffer(data, dtype=np.uint8, count=count, offset=start + 2 * count)
+
+        self.name = self.header["name"]
+        self.description = self.header["description"]
+        self.link = self.header["link"]
+        self.snapshot_id = self.header.get("snapshot_id")
+
+    def decade_counts(self):
+        return DecadeHistogram(self.header["decade_counts"]).counts
+
+
+def load_playlist_details(folder):
+    # The name, description, link and decade counts of a saved playlist, whichever way it was saved
+    snapshot_path = os.path.join(folder, SNAPSHOT_FILE)
+    if os.path.exists(snapshot_path):
+        header = read_snapshot_header(snapshot_path)
+        return {"name": header["name"], "description": header["description"], "link": header["link"],
+                "decade_counts": header["decade_counts"]}
+
+    playlist_data = json_codec.load(os.path.join(folder, "data.json"))
+
+    if "decade_counts" in playlist_data:
+        decade_counts = playlist_data["decade_counts"]
+    else:
+        histogram = DecadeHistogram()
+        histogram.add_tracks(playlist_data["tracks"]["items"])
+        decade_counts = histogram.to_dict()
+
+    return {"name": playlist_data["name"], "description": playlist_data["description"],
+            "link": playlist_data["external_urls"]["spotify"], "decade_counts": decade_counts}
+
+
+def convert_data_json(folder, keep=False):
+    # Turns a playlist folder's data.json into a snapshot.bin. Older instances have every track in their data.json,
+    # newer ones only have their decade counts, in which case the snapshot has no track columns
+    json_path = os.path.join(folder, "data.json")
+
+    playlist_data = json_codec.load(json_path)
+
+    writer = SnapshotWriter()
+    tracks = playlist_data.get("tracks", {})
+
+    if "items" in tracks:
+        writer.add_tracks(tracks["items"])
+    else:
+        writer.histogram = DecadeHistogram(playlist_data.get("decade_counts"))
+
+    writer.write(os.path.join(folder, SNAPSHOT_FILE), playlist_data)
+
+    if not keep:
+        os.remove(json_path)
+
+
+def convert_instances(instances_path="static/spotify_instances", keep=False):
+    # Converts every playlist of every instance that still has a data.json
+    start_time = time.perf_counter()
+    converted = 0
+    saved_bytes = 0
+
+    for json_path in glob.glob(os.path.join(instances_path, "*", "playlist*", "data.json")):
+        folder = os.path.dirname(json_path)
+        try:
+            before = os.path.getsize(json_path)
+            convert_data_json(folder, keep=keep)
+            saved_bytes += before - os.path.getsize(os.path.join(folder, SNAPSHOT_FILE))
+            converted += 1
+        except (OSError, ValueError, KeyError, TypeError):
+            print(f"Snapshot Conversion Error, see: {json_path}")
+
+    print(f"{converted} playlists converted in {time.perf_counter() - start_time:.1f}s, "
+          f"{saved_bytes / 1024 / 1024:.1f}MB smaller")
+
+
+if __name__ == "__main__":
+    # python snapshot_store.py converts the data.json files of existing instances into snapshots
+    parser = argparse.ArgumentParser(description="Convert saved playlists' data.json files into snapshot.bin files")
+    parser.add_argument("--instances", default="static/spotify_instances")
+    parser.add_argument("--keep", action="store_true", help="keep the data.json files after converting them")
+    args = parser.parse_args()
+
+    convert_instances(args.instances, keep=args.keep)
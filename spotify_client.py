@@ -0,0 +1,227 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import json_codec
+from metrics import record_request
+
+# Every request we make to spotify goes through one SpotifyClient shared by the whole process. It keeps connections
+# open between requests, retries the ones that fail for temporary reasons and spaces requests out so that all the
+# reports being made at once stay inside our app's rate limit together
+
+# Where spotify's accounts service and web api are. These can be set in the environment to point the app at something
+# else, like fake_spotify.py when trying it out or benchmarking it without a spotify account
+SPOTIFY_ACCOUNTS_URL = os.environ.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+
+# Spotify compresses its JSON when asked to, which makes a page of tracks several times smaller on the wire. requests
+# asks for it by default anyway, this makes sure it always does, and decompresses it for us as it's read
+ACCEPT_ENCODING = "gzip, deflate"
+
+# How many connections we keep open to each host, this should be at least the number of threads making requests
+POOL_SIZE = 20
+
+# How long we wait on spotify before giving up on a request, in seconds
+REQUEST_TIMEOUT = 15
+
+# Retrying: how many times, which responses are worth retrying, and how long to back off between tries in seconds.
+# BACKOFF_MAX is also the longest Retry-After we'll wait for
+MAX_RETRIES = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# The token bucket: how many requests a second we allow on average and how many can go at once after a quiet spell
+RATE_LIMIT = 10
+RATE_BURST = 20
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+        # When spotify tells us to back off with a Retry-After header nobody gets a token until this time has passed
+        self.paused_until = 0
+
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until there's a token to spend
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                # Topping up the bucket with the tokens earned since we last looked, nothing is earned while we're
+                # paused
+                since = max(self.updated, self.paused_until)
+                if now > since:
+                    self.tokens = min(self.capacity, self.tokens + (now - since) * self.rate)
+                    self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Stops everyone sharing this bucket for the given number of seconds and empties it so they don't all rush
+        # back in at once afterwards. It only starts filling again once the pause is over
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+def retry_after_seconds(response):
+    # The Retry-After header can either be a number of seconds or a date, we return None if it's missing or unreadable
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_seconds(attempt):
+    # Exponential backoff with full jitter, so clients that failed together don't all retry together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# The hosts whose paths are api endpoints. In those paths the part after one of ID_SEGMENTS is an id, so it's left out
+# of the endpoint's name
+API_HOSTS = {urlsplit(SPOTIFY_API_URL).netloc, urlsplit(SPOTIFY_ACCOUNTS_URL).netloc}
+ID_SEGMENTS = {"playlists", "albums", "artists", "tracks", "users", "image"}
+
+
+def endpoint_name(url):
+    # A name for the endpoint a url belongs to for the metrics, so every playlist's requests are counted together
+    # The api's paths have their ids swapped for {id}, and anything on another host (the images) is named by the host
+    parts = urlsplit(url)
+    if parts.netloc not in API_HOSTS:
+        return parts.netloc
+
+    segments = parts.path.strip("/").split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in ID_SEGMENTS:
+            segments[i] = "{id}"
+
+    return parts.netloc + "/" + "/".join(segments)
+
+
+def response_size(response, streamed):
+    # How many bytes of body came over the wire (so after compression), without reading a streamed body that the
+    # caller hasn't read yet
+    if streamed:
+        return int(response.headers.get("Content-Length", 0))
+
+    # Reading the body first, urllib3 counts the bytes as it reads them off the connection, before decompressing
+    body = response.content
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(body)
+
+
+def response_json(response):
+    # The response's body as JSON, read straight from its bytes by json_codec rather than by response.json(), which
+    # decodes the whole body into a string first and then parses it with the slower json module
+    return json_codec.loads(response.content)
+
+
+class SpotifyClient:
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, pool_size=POOL_SIZE, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self.limiter = TokenBucket(rate, burst)
+
+        # A session keeps connections alive between requests, so we only pay for the TLS handshake once per connection
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        endpoint = endpoint_name(url)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+
+            self.limiter.acquire()
+
+            # Every attempt is counted and timed, retries included
+            start_time = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                record_request(endpoint, response.status_code, time.perf_counter() - start_time,
+                               response_size(response, kwargs.get("stream", False)))
+            except (requests.ConnectionError, requests.Timeout) as error:
+                record_request(endpoint, type(error).__name__, time.perf_counter() - start_time, 0)
+                if last_attempt:
+                    raise
+                time.sleep(backoff_seconds(attempt))
+                continue
+
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+
+            # Spotify asks for much longer waits when it's penalising the app, rather than hold up every report for
+            # that long we give the response back now, so the playlist or report it was for fails where it can be seen
+            wait = retry_after_seconds(response)
+            if wait is not None and wait > BACKOFF_MAX:
+                print(f"Spotify Asked Us to Wait {wait:.0f}s, giving up: {url}")
+                return response
+
+            # We're not going to read this response, closing it gives its connection back to the pool
+            response.close()
+
+            if response.status_code == 429:
+                # We've hit the rate limit, this is shared by the whole app so every request holds off, not just ours
+                print(f"Rate Limited by Spotify, waiting {wait if wait is not None else 'a moment'}: {url}")
+                self.limiter.pause(wait if wait is not None else backoff_seconds(attempt))
+            else:
+                time.sleep(wait if wait is not None else backoff_seconds(attempt))
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # The one SpotifyClient for this process, made the first time someone asks for it
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = SpotifyClient()
+
+    return _client
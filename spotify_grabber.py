@@ -1,21 +1,46 @@
 import base64
 import hashlib
-import io
 import json
 import os
-import shutil
 import string
 import secrets
-from PIL import Image
-
-import requests
-
-from playlist_analyser import PlaylistAnalyser
+import time
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import json_codec
+from spotify_client import get_client, response_json, SPOTIFY_ACCOUNTS_URL, SPOTIFY_API_URL
+from album_index import get_album_index
+from instance_registry import create_instance
+from metrics import current_trace, timed, tracing
+from playlist_analyser import PlaylistAnalyser, RENDER_SETTINGS, COVER_FILE
+from render_cache import cache_key, get_render_cache
+from report_manifest import write_report_manifest
+from snapshot_store import SnapshotWriter, SNAPSHOT_FILE, read_snapshot_header
 
 # This will need to be replaced with the client id of your spotify app and your server name
 SERVER_NAME = "https://replace_with_your_server_name.com"
 CLIENT_ID = "replace_with_your_client_id"
 
+# How many playlists we fetch at once, most of the time spent on a playlist is waiting on spotify so overlapping them
+# saves a lot of time. Setting this to 1 gives the old one-after-another behaviour
+MAX_CONCURRENT_PLAYLISTS = 4
+
+# We only ask spotify for the parts of a playlist we actually use, the tracks only need their album's id and release
+# date. The id is for the album index, which remembers every album's release year across reports
+TRACK_FIELDS = "next,items(track(album(id,release_date,release_date_precision)))"
+PLAYLIST_FIELDS = f"id,name,description,external_urls,snapshot_id,tracks(total,{TRACK_FIELDS})"
+
+# A report has at most MAX_PLAYLISTS playlists, each with more than MIN_PLAYLIST_TRACKS tracks. We look through the
+# user's playlists PLAYLIST_PAGE_LIMIT at a time (the most spotify allows) until we've found that many
+MAX_PLAYLISTS = 20
+MIN_PLAYLIST_TRACKS = 3
+PLAYLIST_PAGE_LIMIT = 50
+
+# Cover art bigger than this isn't downloaded, spotify's are usually well under 200KB. It's read this much at a time
+MAX_COVER_BYTES = 8 * 1024 * 1024
+COVER_CHUNK_SIZE = 64 * 1024
+
 
 def generate_verifier():
     # Generates the code_verifier and code_challenge for the PKCE extension method
@@ -40,45 +65,6 @@ def generate_verifier():
     return code_verifier, code_challenge
 
 
-def get_next_instance_id():
-    # Our instance id's begin with an order number and then have a sequence of 10 random characters afterward
-    # The order number will climb indefinitely, so it will reference what instance the user was totally
-    # After 10 instances, the oldest instance (the intance_id with the lowest order number) will be deleted
-    # The order number and the random characters are separated by a '-'
-
-    MAX_INSTANCES = 5
-
-    # If there hasn't been an instance yet then we'll pretend there's a 0th instance, so we begin at 1
-    if not os.listdir("static/spotify_instances"):
-        id_list = [str(0)]
-    else:
-        id_list = os.listdir("static/spotify_instances")
-
-    # Getting the order number, the 'iter_id', for iteration id
-    iter_id = []
-    for id in id_list:
-        iter_id.append(int(id.split("_")[0]))
-
-    oldest_id_index = iter_id.index(min(iter_id))
-
-    # Removing the oldest instance
-    if len(id_list) >= MAX_INSTANCES:
-        shutil.rmtree(f"static/spotify_instances/{id_list[oldest_id_index]}", ignore_errors=True)
-        print(iter_id[oldest_id_index])
-
-    # The next iter_id will be 1 more than the biggest current one
-    next_id_begin = str(max(iter_id) + 1)
-
-    # Producing a random string with the same method as the code_verifier
-    id_alphabet = string.ascii_letters + string.digits
-    next_id_end = "".join(secrets.choice(id_alphabet) for i in range(10))
-
-    #Concatenating the iter_id and the random string
-    next_id = next_id_begin + "_" + next_id_end
-
-    return next_id
-
-
 # The SpotifyGrabber class is what I'll use to request data from the spotify API.
 
 # I use Authorisation Code Flow through the web API which you can find a tutorial for here:
@@ -94,13 +80,15 @@ class SpotifyGrabber:
         # We do this so the server can pull data from the users spotify account on demand
 
         self.token = None
+        self.progress = None
         if (instance_id == None):
 
             if not os.path.exists("static/spotify_instances"):
                 os.mkdir("static/spotify_instances")
 
-            # This is the function we've defined which gets a unique instance_id for the user
-            self.instance_id = get_next_instance_id()
+            # The instance registry gives us a unique instance_id for the user, old instances are deleted by the
+            # registry in the background so there's nothing to clear out here
+            self.instance_id = create_instance()
 
             # Generating the code_challenge and code_verifier
             (self.code_verifier, self.code_challenge) = generate_verifier()
@@ -136,6 +124,10 @@ class SpotifyGrabber:
 
                     self.instance_id = instance_id
                     self.code_verifier = instance_data["code_verifier"]
+
+                    # A report that was interrupted part way through may already have swapped its auth code for a
+                    # token, auth codes only work once so we carry on with that token
+                    self.token = instance_data["tokens"].get("access_token")
             except:
                 print(f"Spotify Grabber Instance: {instance_id} Cannot Be Found Error")
 
@@ -159,9 +151,9 @@ class SpotifyGrabber:
 
         # We send the request to spotify
         try:
-            auth = requests.get("https://accounts.spotify.com/authorize", params=auth_params)
+            auth = get_client().get(f"{SPOTIFY_ACCOUNTS_URL}/authorize", params=auth_params)
         except:
-            print("Network Error When Accessing: https://accounts.spotify.com/authorize ")
+            print(f"Network Error When Accessing: {SPOTIFY_ACCOUNTS_URL}/authorize ")
 
         # Spotify gives us a url for the user to sign in to their spotify and give us permissions
 
@@ -173,53 +165,85 @@ class SpotifyGrabber:
         # These access tokens are temporary and need to be renewed
         # They're what we'll need in order to make our data requests from spotify
 
-        auth = requests.post("https://accounts.spotify.com/api/token",
-                             headers={"Content-Type": "application/x-www-form-urlencoded"},
-                             data={"grant_type": "authorization_code",
-                                   "code": auth_code,
-                                   "redirect_uri": f"{SERVER_NAME}/validate/",
-                                   "client_id": CLIENT_ID,
-                                   "code_verifier": self.code_verifier})
+        with timed("token_exchange"):
+            auth = get_client().post(f"{SPOTIFY_ACCOUNTS_URL}/api/token",
+                                     headers={"Content-Type": "application/x-www-form-urlencoded"},
+                                     data={"grant_type": "authorization_code",
+                                           "code": auth_code,
+                                           "redirect_uri": f"{SERVER_NAME}/validate/",
+                                           "client_id": CLIENT_ID,
+                                           "code_verifier": self.code_verifier})
         try:
-            self.token = auth.json()["access_token"]
+            self.token = response_json(auth)["access_token"]
+            self.save_token()
         except:
-            with open(f"static/spotify_instances/{self.instance_id}/data/error.json", "w") as f:
-                f.write(auth.text)
+            with open(f"static/spotify_instances/{self.instance_id}/data/error.json", "wb") as f:
+                f.write(auth.content)
             print(f"Request Token Error, See: static/spotify_instances/{self.instance_id}/data/error.json for Response")
 
-    def save_user_playlists(self):
+    def save_token(self):
+        # Saving the token in the instance's data file so the report can be picked up again if it gets interrupted
+        instance_path = f"static/spotify_instances/{self.instance_id}/data/instance_data.json"
 
-        # We request a data file on the users playlists
+        with open(instance_path, "r") as instance_file:
+            instance_data = json.load(instance_file)
 
-        response = requests.get(f"https://api.spotify.com/v1/me/playlists",
-                                headers={"Authorization": "Bearer " + self.token,
-                                         "Content-Type": "application/json"})
+        instance_data["tokens"] = {"access_token": self.token}
 
-        playlists_data = response.json()
+        with open(instance_path, "w") as instance_file:
+            json.dump(instance_data, instance_file)
 
-        try:
-            playlists_data["items"]
-        except:
-            with open(f"static/spotify_instances/{self.instance_id}/data/error.json", "w") as f:
-                f.write(response.text)
-            print(f"Token Use Error, See: static/spotify_instances/{self.instance_id}/data/error.json for Response")
+    def report_progress(self, playlist, status):
+        # Letting whoever asked for the report know how each playlist is getting on
+        if self.progress is not None:
+            self.progress(playlist["playlist_number"], playlist["name"], status)
+
+    def user_playlist_items(self):
+        # Gives the user's playlists one at a time, fetching them from spotify PLAYLIST_PAGE_LIMIT at a time
+        # The next page is only fetched once the caller has gone through this one, so if they stop early it never is
+        url = f"{SPOTIFY_API_URL}/me/playlists"
+        params = {"limit": PLAYLIST_PAGE_LIMIT}
+
+        while url:
+            with timed("playlist_list"):
+                response = get_client().get(url,
+                                            params=params,
+                                            headers={"Authorization": "Bearer " + self.token,
+                                                     "Content-Type": "application/json"})
+
+            playlists_data = response_json(response)
+
+            try:
+                items = playlists_data["items"]
+            except:
+                with open(f"static/spotify_instances/{self.instance_id}/data/error.json", "wb") as f:
+                    f.write(response.content)
+                print(f"Token Use Error, See: static/spotify_instances/{self.instance_id}/data/error.json for Response")
+                raise
+
+            yield from items
+
+            # Spotify's next url already has the limit and offset in it
+            url = playlists_data.get("next")
+            params = None
 
-        # We create a list of dictionaries with info on the first four non spotify playlists
+    def save_user_playlists(self, max_workers=MAX_CONCURRENT_PLAYLISTS, progress=None):
+        # progress, if given, is called with (playlist_number, name, status) whenever a playlist moves along
+        self.progress = progress
+
+        # We create a list of dictionaries with info on the first MAX_PLAYLISTS non spotify playlists
+        # The user's playlists are fetched a page at a time as we go, so we stop asking for more once we have enough
 
         i = 0
         playlist_list = []
-        for item in playlists_data["items"]:
-
-            # We get a maximum of 20 playlists (index starts at 0)
-            if (i > 19):
-                break
+        for item in self.user_playlist_items():
 
             # We want to ignore any playlists made by spotify such as blends and 'made for you' mixes and any playlists
             # which have less than 3 tracks in them
 
             try:
                 conditions = (item["owner"]["display_name"] != "Spotify") \
-                             and (int(item["tracks"]["total"]) > 3)
+                             and (int(item["tracks"]["total"]) > MIN_PLAYLIST_TRACKS)
             except:
                 conditions = False
                 print(f"Playlist Conditions Error with Playlist {i} in Instance {self.instance_id}")
@@ -230,6 +254,7 @@ class SpotifyGrabber:
                 playlist_entry = {"name": item["name"],
                                   "description": item["description"],
                                   "link_id": item["id"],
+                                  "snapshot_id": item.get("snapshot_id"),
                                   "playlist_number": i}
 
                 try:
@@ -243,55 +268,220 @@ class SpotifyGrabber:
 
                 i += 1
 
+                # We get a maximum of MAX_PLAYLISTS playlists, stopping here means we don't fetch another page
+                if i >= MAX_PLAYLISTS:
+                    break
+
             else:
                 print(f"Error with Playlist Data Entry, see: static/spotify_instances/{self.instance_id}"
                       f"/data/playlist_data.json for errors")
                 pass
 
         # Writing the dictionary to a file so we can access it when we need to
-        json_file = json.dumps(playlist_list)
-        with open(f"static/spotify_instances/{self.instance_id}/data/playlist_data.json", "w") as f:
-            f.write(json_file)
-
-        # Now for each playlist we're going to create a folder with a data file, it's image and with the graph we want
+        json_codec.dump(playlist_list, f"static/spotify_instances/{self.instance_id}/data/playlist_data.json")
 
         for playlist in playlist_list:
+            self.report_progress(playlist, "queued")
 
-            try:
-                # Rather than doing the 'i' thing again we can just use the playlist number
-                x = playlist['playlist_number']
+        # Now for each playlist we're going to create a folder with a snapshot file, it's image and with the graph we want
+        # The playlists are handed to a pool of threads so their requests and drawing overlap. Every playlist has its
+        # playlist_number, so the playlistN folders come out the same no matter which playlist finishes first
 
-                # Making the request
-                response = requests.get(f"https://api.spotify.com/v1/playlists/{playlist['link_id']}",
-                                        headers={"Authorization": "Bearer " + self.token,
-                                                 "Content-Type": "application/json"})
+        start_time = time.perf_counter()
 
-                # Making the folder
-                os.mkdir(f"static/spotify_instances/{self.instance_id}/playlist{x}")
+        # The pool's threads aren't ours, so each playlist carries on with this thread's trace if it has one
+        trace = current_trace()
 
-                # Saving the data file
-                json_file = json.dumps(response.json())
-                with open(f"static/spotify_instances/{self.instance_id}/playlist{x}/data.json", "w") as f:
-                    f.write(json_file)
+        def save_timed(playlist):
+            with tracing(trace), timed("playlist", playlist=playlist["playlist_number"]):
+                self.save_playlist(playlist)
 
-                # Making a request for the image
-                # Again, requesting images from spotify can lead to errors so we should be careful
-                try:
-                    response = requests.get(playlist["art_url"],
+        if max_workers <= 1:
+            for playlist in playlist_list:
+                save_timed(playlist)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(save_timed, playlist_list))
+
+        # Writing down everything the report page needs now the report is finished
+        with timed("manifest_write"):
+            write_report_manifest(self.instance_id, playlist_list)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"{len(playlist_list)} playlists saved in {elapsed:.2f}s with {max(max_workers, 1)} workers "
+              f"in Instance {self.instance_id}")
+
+        album_stats = get_album_index().stats()
+        print(f"Album index: {album_stats['hit_rate']:.0%} of albums already known, "
+              f"{album_stats.get('added', 0)} added, {album_stats.get('filled', 0)} tracks filled in")
+
+        return elapsed
+
+    def save_playlist(self, playlist):
+        # This creates the folder for a single playlist with its snapshot, image and graph
+        # Any error is kept to this playlist so the rest of the report can still be made
+
+        try:
+            # Rather than doing the 'i' thing again we can just use the playlist number
+            x = playlist['playlist_number']
+            folder = f"static/spotify_instances/{self.instance_id}/playlist{x}"
+
+            # If this version of the playlist has been drawn before, for this user or anyone else, we can copy those
+            # files and skip both the requests and the drawing
+            # A report that was interrupted and picked up again may have already finished this playlist, if spotify
+            # still has the same version of it there's nothing to do
+            if self.playlist_up_to_date(playlist, folder):
+                print(f"playlist{x} unchanged")
+                self.report_progress(playlist, "done")
+                return
+
+            with timed("cache_restore", playlist=x):
+                restored = playlist.get("snapshot_id") and self.restore_cached_playlist(playlist, folder)
+
+            if restored:
+                print(f"playlist{x} restored from cache")
+                self.report_progress(playlist, "cached")
+                return
+
+            self.report_progress(playlist, "fetching")
+
+            # Making the request, this gets the playlist's details along with its first page of tracks
+            with timed("playlist_fetch", playlist=x):
+                response = get_client().get(f"{SPOTIFY_API_URL}/playlists/{playlist['link_id']}",
+                                            params={"fields": PLAYLIST_FIELDS},
                                             headers={"Authorization": "Bearer " + self.token,
                                                      "Content-Type": "application/json"})
-                    im = Image.open(io.BytesIO(response.content))
-                except:
-                    print("image error")
 
-                # Saving the image using Pillow
-                im.save(f"static/spotify_instances/{self.instance_id}/playlist{x}/playlist_image.png")
-                print(f"playlist_image{x} saved")
+                # If spotify still wouldn't give us the playlist after retrying we give up on just this one
+                response.raise_for_status()
+                playlist_data = response_json(response)
 
-                # Using a PlaylistAnalyser object to create our graph
-                analyser = PlaylistAnalyser(instance_id=self.instance_id, playlist_num=x)
-                analyser.create_year_graph()
-                print(f"graph_image{x} saved")
+            # Keeping just the release year and precision of each track from each page as it arrives, along with the
+            # decade counts, and then dropping the page. That way a playlist with thousands of tracks takes 3 bytes a
+            # track in memory rather than however much JSON spotify sent for it
+            snapshot = SnapshotWriter()
+            page = playlist_data.pop("tracks")
+            playlist_data["tracks"] = {"total": page.get("total")}
+
+            while True:
+                with timed("decade_count", playlist=x):
+                    get_album_index().add_tracks(page["items"])
+                    snapshot.add_tracks(page["items"])
+
+                if not page.get("next"):
+                    break
+
+                with timed("track_page_fetch", playlist=x):
+                    page = self.get_track_page(page["next"])
 
+            # Making the folder
+            # A report that was interrupted may have already made this folder
+            os.makedirs(folder, exist_ok=True)
+
+            # Saving the playlist's snapshot, its details and its tracks' release years
+            with timed("snapshot_write", playlist=x):
+                snapshot.write(f"{folder}/{SNAPSHOT_FILE}", playlist_data)
+
+            # Making a request for the image
+            # Again, requesting images from spotify can lead to errors so we should be careful
+            try:
+                with timed("image_download", playlist=x):
+                    cover_data = self.download_cover(playlist["art_url"])
             except:
-                print(f"Issue with Playlist Error, number: {playlist['playlist_number']}")
+                print("image error")
+                raise
+
+            # Keeping the cover's bytes just as they came, so a heading can be drawn again later from the render
+            # cache. The heading we draw now is made from the bytes we already have, they're only decoded once
+            with timed("image_save", playlist=x):
+                with open(f"{folder}/{COVER_FILE}", "wb") as f:
+                    f.write(cover_data)
+            print(f"playlist_image{x} saved")
+            self.report_progress(playlist, "rendering")
+
+            # Using a PlaylistAnalyser object to create our graph, the drawing itself happens in the render engine's
+            # worker processes so several playlists can be drawn at once
+            with timed("analyser_load", playlist=x):
+                analyser = PlaylistAnalyser(instance_id=self.instance_id, playlist_num=x)
+            if not analyser.create_year_graph(cover_data):
+                # Without its images the playlist can't be shown, so it counts as failed rather than done
+                print(f"Playlist Render Error, number: {x}")
+                self.report_progress(playlist, "failed")
+                return
+            print(f"graph_image{x} saved")
+
+            # Keeping everything we made so the next report with this playlist in it can reuse it
+            if playlist.get("snapshot_id") and os.path.exists(f"{folder}/final_heading.jpg"):
+                with timed("cache_store", playlist=x):
+                    get_render_cache().store(self.playlist_cache_key(playlist), folder, x)
+
+            self.report_progress(playlist, "done")
+
+        except:
+            print(f"Issue with Playlist Error, number: {playlist['playlist_number']}")
+            self.report_progress(playlist, "failed")
+
+    def playlist_up_to_date(self, playlist, folder):
+        # Whether the folder already has everything for this version of the playlist
+        snapshot_path = f"{folder}/{SNAPSHOT_FILE}"
+        if not (playlist.get("snapshot_id") and os.path.exists(snapshot_path)
+                and os.path.exists(f"{folder}/graph.jpg") and os.path.exists(f"{folder}/final_heading.jpg")):
+            return False
+
+        try:
+            return read_snapshot_header(snapshot_path)["snapshot_id"] == playlist["snapshot_id"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def playlist_cache_key(self, playlist):
+        return cache_key(playlist["link_id"], playlist["snapshot_id"], RENDER_SETTINGS)
+
+    def restore_cached_playlist(self, playlist, folder):
+        # Fills in the playlist's folder from the render cache, returning False if it wasn't cached
+        key = self.playlist_cache_key(playlist)
+        cache = get_render_cache()
+
+        if not cache.restore(key, folder):
+            return False
+
+        # The heading has the playlist's position in the report drawn on it, so if this playlist was somewhere else in
+        # the report last time we draw just the heading again
+        if not cache.restore_heading(key, folder, playlist["playlist_number"]):
+            analyser = PlaylistAnalyser(instance_id=self.instance_id, playlist_num=playlist["playlist_number"])
+            analyser.generate_final_image()
+            cache.store(key, folder, playlist["playlist_number"])
+
+        return True
+
+    def download_cover(self, url):
+        # Reads the cover art a chunk at a time, giving up on anything over MAX_COVER_BYTES so that one huge image
+        # can't take up the memory of a server that's making lots of reports at once
+        with get_client().get(url,
+                              stream=True,
+                              headers={"Authorization": "Bearer " + self.token}) as response:
+            response.raise_for_status()
+
+            if int(response.headers.get("Content-Length", 0)) > MAX_COVER_BYTES:
+                raise ValueError(f"Cover art is over {MAX_COVER_BYTES} bytes: {url}")
+
+            cover_data = bytearray()
+            for chunk in response.iter_content(COVER_CHUNK_SIZE):
+                cover_data += chunk
+                if len(cover_data) > MAX_COVER_BYTES:
+                    raise ValueError(f"Cover art is over {MAX_COVER_BYTES} bytes: {url}")
+
+        return bytes(cover_data)
+
+    def get_track_page(self, next_url):
+        # Spotify hands us the url of the next page of tracks, which already has its offset and limit, we just make
+        # sure it's still only sending the fields that we asked for
+        params = {}
+        if "fields" not in parse_qs(urlsplit(next_url).query):
+            params["fields"] = TRACK_FIELDS
+
+        response = get_client().get(next_url,
+                                    params=params,
+                                    headers={"Authorization": "Bearer " + self.token,
+                                             "Content-Type": "application/json"})
+        response.raise_for_status()
+        return response_json(response)
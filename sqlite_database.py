@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# The job queue, the instance registry and the album index each keep an SQLite file, and they all open it the same
+# way: in autocommit mode (anything that needs a transaction starts one itself), waiting up to 30 seconds for another
+# process that's writing, and in WAL mode so readers carry on while someone writes
+
+# The databases this process has made the tables of
+_tables_created = set()
+_tables_created_lock = threading.Lock()
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+@contextmanager
+def open_database(path, create_tables):
+    # A connection to the database at path which is closed when we're done with it. create_tables(connection) is
+    # called the first time this process opens that database, it should only make what doesn't exist yet
+    connection = connect(path)
+    try:
+        with _tables_created_lock:
+            created = path in _tables_created
+
+        if not created:
+            create_tables(connection)
+            with _tables_created_lock:
+                _tables_created.add(path)
+
+        yield connection
+    finally:
+        connection.close()